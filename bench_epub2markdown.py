@@ -0,0 +1,471 @@
+import gc
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+import epub2markdown as e2m
+
+def _legacy_locate_toc_points(raw, points):
+    # 旧实现：每个片段用六个正则全文搜索，作为定位结果与耗时的对照
+    positions = []
+    for gid, frag, title in points:
+        pos = None
+        if frag:
+            pats = [
+                rf'id\s*=\s*"{re.escape(frag)}"',
+                rf"id\s*=\s*'{re.escape(frag)}'",
+                rf'name\s*=\s*"{re.escape(frag)}"',
+                rf"name\s*=\s*'{re.escape(frag)}'",
+                rf'xml:id\s*=\s*"{re.escape(frag)}"',
+                rf"xml:id\s*=\s*'{re.escape(frag)}'",
+            ]
+            for pat in pats:
+                m = re.search(pat, raw)
+                if m:
+                    s = m.start()
+                    tag_open = raw.rfind("<", 0, s)
+                    pos = tag_open if tag_open != -1 else s
+                    break
+        if pos is None:
+            pos = 0
+        positions.append((gid, title, frag, pos))
+    positions.sort(key=lambda x: x[3])
+    return positions
+
+def make_anchor_html(n_anchors):
+    attrs = ['id="{0}"', "id='{0}'", 'name="{0}"', 'xml:id="{0}"']
+    parts = ['<?xml version="1.0" encoding="utf-8"?>\n<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Omnibus</title></head><body>']
+    for i in range(1, n_anchors + 1):
+        attr = attrs[i % len(attrs)].format(f"chapter-{i}")
+        parts.append(f'<h2 {attr}>Chapter {i}</h2>')
+        parts.append(f'<p>Once upon a time, in chapter {i}, a dragon met a child.</p>' * 3)
+    parts.append('</body></html>')
+    return "".join(parts)
+
+def _best_of(fn, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None or dt < best else best
+    return best, result
+
+def bench_anchor_segmentation(n_anchors=2000, repeat=3):
+    raw = make_anchor_html(n_anchors)
+    points = [(i, f"chapter-{i}", f"Chapter {i}") for i in range(1, n_anchors + 1)]
+    legacy_s, legacy_pos = _best_of(lambda: _legacy_locate_toc_points(raw, points), repeat)
+    index_s, index_pos = _best_of(lambda: e2m._locate_toc_points(raw, points), repeat)
+    return {
+        "name": "anchor_segmentation",
+        "anchors": n_anchors,
+        "html_bytes": len(raw.encode("utf-8")),
+        "legacy_locate_s": round(legacy_s, 6),
+        "index_locate_s": round(index_s, 6),
+        "speedup": round(legacy_s / index_s, 1) if index_s else None,
+        "positions_match": legacy_pos == index_pos,
+    }
+
+# ---------------- 合成EPUB ----------------
+
+_CONTAINER_XML = ('<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                  '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>')
+_WORDS = ("the dragon met a little girl who lived by the sea and every morning they read "
+          "stories about stars rivers mountains and brave foxes together under an old tree").split()
+
+def _paragraph(rnd, n_words):
+    words = [rnd.choice(_WORDS) for _ in range(n_words)]
+    words[0] = words[0].capitalize()
+    return f"<p>{' '.join(words)}.</p>"
+
+def _xhtml(title, body):
+    return ('<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">'
+            f'<head><title>{title}</title></head><body>{body}</body></html>')
+
+def _nav_xhtml(points):
+    lis = "".join(f'<li><a href="{href}">{label}</a></li>' for href, label in points)
+    return _xhtml("Contents", f'<nav epub:type="toc" id="toc"><ol>{lis}</ol></nav>')
+
+def _toc_ncx(points):
+    nps = "".join(f'<navPoint id="np{i}" playOrder="{i}"><navLabel><text>{label}</text></navLabel><content src="{href}"/></navPoint>'
+                  for i, (href, label) in enumerate(points, 1))
+    return ('<?xml version="1.0" encoding="utf-8"?><ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+            f'<head/><docTitle><text>Synthetic</text></docTitle><navMap>{nps}</navMap></ncx>')
+
+def write_synthetic_epub(path, title, chapters, toc="nav", images=(), seed=0):
+    """
+    写出一个合成EPUB。
+    chapters: [(文件名, xhtml内容, [(href片段, 目录标签), ...])]；toc: 'nav' / 'ncx' / 'none'；
+    images: [(文件名, 字节)]，以 ZIP_STORED 写入以模拟不可压缩的扫描图。
+    """
+    items = []
+    spine = []
+    points = []
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip")
+        z.writestr("META-INF/container.xml", _CONTAINER_XML)
+        for i, (name, html, toc_points) in enumerate(chapters):
+            z.writestr(f"OEBPS/Text/{name}", html)
+            items.append(f'<item id="c{i}" href="Text/{name}" media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="c{i}"/>')
+            points.extend((f"Text/{name}{frag}", label) for frag, label in toc_points)
+        for i, (name, data) in enumerate(images):
+            z.writestr(f"OEBPS/Images/{name}", data, compress_type=zipfile.ZIP_STORED)
+            items.append(f'<item id="img{i}" href="Images/{name}" media-type="image/jpeg"/>')
+        if toc == "nav":
+            z.writestr("OEBPS/nav.xhtml", _nav_xhtml(points))
+            items.append('<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>')
+        elif toc == "ncx":
+            z.writestr("OEBPS/toc.ncx", _toc_ncx(points))
+            items.append('<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>')
+        z.writestr("OEBPS/content.opf", (
+            '<?xml version="1.0" encoding="utf-8"?><package xmlns="http://www.idpf.org/2007/opf" version="3.0">'
+            f'<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>{title}</dc:title>'
+            '<dc:creator>Bench</dc:creator></metadata>'
+            f'<manifest>{"".join(items)}</manifest><spine>{"".join(spine)}</spine></package>'))
+    return path
+
+def _shape_many_small(path, scale, rnd, toc):
+    n = max(1, int(400 * scale))
+    chapters = []
+    for i in range(1, n + 1):
+        body = f"<h1>{i}</h1><h2>Chapter {i}</h2>" + "".join(_paragraph(rnd, 30) for _ in range(5))
+        chapters.append((f"ch{i:04d}.xhtml", _xhtml(f"Chapter {i}", body), [("", f"Chapter {i}")]))
+    return write_synthetic_epub(path, f"many_small_{toc}", chapters, toc=toc)
+
+def _shape_giant_fragments(path, scale, rnd, toc):
+    n = max(1, int(2000 * scale))
+    parts = []
+    toc_points = []
+    for i in range(1, n + 1):
+        parts.append(f'<h2 id="chapter-{i}">Chapter {i}</h2>')
+        parts.extend(_paragraph(rnd, 25) for _ in range(3))
+        toc_points.append((f"#chapter-{i}", f"Chapter {i}"))
+    chapters = [("omnibus.xhtml", _xhtml("Omnibus", "".join(parts)), toc_points)]
+    return write_synthetic_epub(path, f"giant_fragments_{toc}", chapters, toc=toc)
+
+def _shape_image_heavy(path, scale, rnd, toc):
+    n = max(1, int(60 * scale))
+    chapters = []
+    images = []
+    for i in range(1, n + 1):
+        images.append((f"page{i:03d}.jpg", rnd.randbytes(400 * 1024)))
+        body = f'<h1>Page {i}</h1><div><img src="../Images/page{i:03d}.jpg" alt="page {i}"/></div>' + _paragraph(rnd, 12)
+        chapters.append((f"page{i:03d}.xhtml", _xhtml(f"Page {i}", body), [("", f"Page {i}")]))
+    return write_synthetic_epub(path, f"image_heavy_{toc}", chapters, toc=toc, images=images)
+
+# 形状名 -> (生成函数, 目录类型)
+SHAPES = {
+    "many_small_nav": (_shape_many_small, "nav"),
+    "many_small_ncx": (_shape_many_small, "ncx"),
+    "many_small_notoc": (_shape_many_small, "none"),
+    "giant_fragments_nav": (_shape_giant_fragments, "nav"),
+    "giant_fragments_ncx": (_shape_giant_fragments, "ncx"),
+    "image_heavy_nav": (_shape_image_heavy, "nav"),
+}
+
+def make_shape(shape, out_dir, scale=1.0, seed=0):
+    fn, toc = SHAPES[shape]
+    return fn(os.path.join(out_dir, f"{shape}.epub"), scale, random.Random(seed), toc)
+
+# ---------------- 基准运行 ----------------
+
+def bench_epub(epub_path, text_backend="auto", repeat=1):
+    """
+    对单本EPUB测量端到端耗时与分阶段耗时（转换器自带的阶段统计），
+    峰值内存用 tracemalloc 在单独一次运行中测量，避免影响计时。
+    """
+    backend = e2m._get_text_backend(text_backend)
+    out_root = tempfile.mkdtemp(prefix="e2m-bench-")
+    try:
+        def convert(stats=None):
+            shutil.rmtree(out_root, ignore_errors=True)
+            report = {}
+            e2m.convert_epub_to_markdown(epub_path, out_root, interactive=False, report=report,
+                                         text_backend=backend.name, stats=stats)
+            return report
+        # 预热一次，排除 libxml2 等首次初始化开销
+        convert()
+        wall_s, report = _best_of(convert, repeat)
+        stages = None
+        for _ in range(repeat):
+            st = e2m._ConversionStats()
+            convert(st)
+            s = {name: rec["seconds"] for name, rec in st.stages.items()}
+            stages = s if stages is None else {k: min(v, s.get(k, v)) for k, v in stages.items()}
+        tracemalloc.start()
+        try:
+            convert()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    finally:
+        shutil.rmtree(out_root, ignore_errors=True)
+    return {
+        "epub_bytes": os.path.getsize(epub_path),
+        "text_backend": backend.name,
+        "chapters": report.get("chapters", 0),
+        "lines": report.get("lines", 0),
+        "wall_s": round(wall_s, 6),
+        "stages_s": {k: round(v, 6) for k, v in stages.items()},
+        "peak_traced_bytes": peak,
+    }
+
+def run_suite(shapes, scale=1.0, repeat=1, text_backend="auto", keep_dir=None):
+    work_dir = keep_dir or tempfile.mkdtemp(prefix="e2m-epubs-")
+    os.makedirs(work_dir, exist_ok=True)
+    results = []
+    try:
+        for shape in shapes:
+            path = make_shape(shape, work_dir, scale)
+            r = bench_epub(path, text_backend, repeat)
+            r["name"] = shape
+            results.append(r)
+            print(f"{shape:<22} {r['wall_s']:>8.3f}s  {r['chapters']:>5} 章  峰值 {r['peak_traced_bytes'] / 1048576:>7.1f}MB  "
+                  + " ".join(f"{k}={v:.3f}" for k, v in r["stages_s"].items()))
+    finally:
+        if not keep_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare_results(baseline, current, threshold=0.10):
+    """按名称对比两份结果，返回耗时或峰值内存变差超过 threshold 的条目。"""
+    base = {r["name"]: r for r in baseline.get("results", [])}
+    regressions = []
+    for r in current.get("results", []):
+        b = base.get(r["name"])
+        if not b:
+            continue
+        for metric in ("wall_s", "peak_traced_bytes"):
+            if metric in r and b.get(metric):
+                ratio = r[metric] / b[metric]
+                print(f"{r['name']:<22} {metric:<18} {b[metric]:>12} -> {r[metric]:>12} ({ratio - 1:+.1%})")
+                if ratio > 1 + threshold:
+                    regressions.append((r["name"], metric, ratio))
+    return regressions
+
+# 样本书里不一定出现、但后端之间容易不一致的写法，每次比较都会先跑一遍
+_BACKEND_CASES = {
+    "ruby": "<html><body><h2>小<ruby>猫<rt>māo</rt></ruby></h2><p><ruby>小<rp>(</rp><rt>xiǎo</rt><rp>)</rp></ruby>"
+            "猫<ruby>猫<rp>(</rp><rt>māo</rt><rp>)</rp></ruby>在睡觉。</p></body></html>",
+    "cdata_entities": "<html><body><p>a<![CDATA[ c&d &amp x<y ]]>b &foo &amp; &lt</p></body></html>",
+    "deep_nesting": "<html><body>" + "<div>" * 300 + "deep" + "</div>" * 300 + "<p>after</p></body></html>",
+    "huge_text_node": "<html><body><p>" + "x" * (12 * 1024 * 1024) + "</p><p>after</p></body></html>",
+}
+
+def compare_text_backends(epub_paths, candidate="lxml"):
+    """
+    先在内置样例上、再在样本书上逐个 spine 成员比较 bs4 参考实现与候选后端的输出（正文行、标题候选、<title>）。
+    返回 (比较的文档数, 不一致列表, 各后端耗时)。
+    """
+    ref = e2m._Bs4TextBackend()
+    cand = e2m._get_text_backend(candidate)
+    compared = 0
+    mismatches = []
+    seconds = {ref.name: 0.0, cand.name: 0.0}
+
+    def compare(source, path, html):
+        nonlocal compared
+        results = {}
+        for backend in (ref, cand):
+            t0 = time.perf_counter()
+            text, headings, page_title = backend.document(html)
+            seconds[backend.name] += time.perf_counter() - t0
+            results[backend.name] = (e2m._text_to_lines(text), headings, str(page_title) if page_title else None)
+        compared += 1
+        if results[ref.name] != results[cand.name]:
+            mismatches.append((source, path))
+
+    for name, html in _BACKEND_CASES.items():
+        compare("<内置样例>", name, html)
+    for epub_path in epub_paths:
+        with zipfile.ZipFile(epub_path) as z:
+            archive = e2m._EpubArchive(z)
+            opf_path = archive.find_opf()
+            package = e2m._parse_package(archive, opf_path) if opf_path else None
+            members = [i.path for i in package.spine if archive.exists(i.path)] if package else []
+            for path in members or archive.html_members():
+                compare(epub_path, path, archive.read_text(path))
+    return compared, mismatches, seconds
+
+def _legacy_bs4_document(html):
+    # 旧实现：get_text、find_all 与 soup.title 各自遍历整棵树
+    soup = e2m.BeautifulSoup(html, "html.parser")
+    text = soup.get_text(separator="\n", strip=True)
+    headings = [h.get_text(separator=" ", strip=True) for h in soup.find_all(["h1", "h2", "h3", "h4", "h5", "h6"])]
+    page_title = soup.title.string if soup.title else None
+    return text, headings, page_title
+
+def _legacy_lxml_document(backend, html):
+    # 旧实现：正文一次 XPath，标题与 <title> 再各自遍历
+    root = backend._parse(html)
+    if root is None:
+        return "", [], None
+    text = backend._join(backend._all_text(root), "\n")
+    headings = [backend._join(backend._node_text(h), " ") for h in root.iter("h1", "h2", "h3", "h4", "h5", "h6")]
+    page_title = None
+    el = next(root.iter("title"), None)
+    while el is not None:
+        children = list(el)
+        if not children:
+            page_title = el.text
+            break
+        if len(children) == 1 and not el.text and not children[0].tail and isinstance(children[0].tag, str):
+            el = children[0]
+        else:
+            break
+    return text, headings, page_title
+
+def bench_title_detection(epub_paths, repeat=1):
+    """
+    在样本书上比较单次遍历的 document() 与旧的多次遍历实现：
+    自动章节标题、正文行、标题候选必须完全一致，同时记录两者耗时。
+    返回 {后端名: {"documents", "mismatches", "parse_s", "legacy_s", "current_s", "extract_speedup"}}。
+    """
+    backends = [e2m._Bs4TextBackend()]
+    try:
+        backends.append(e2m._LxmlTextBackend())
+    except ImportError:
+        pass
+    docs = []
+    for epub_path in epub_paths:
+        with zipfile.ZipFile(epub_path) as z:
+            archive = e2m._EpubArchive(z)
+            opf_path = archive.find_opf()
+            package = e2m._parse_package(archive, opf_path) if opf_path else None
+            members = [i.path for i in package.spine if archive.exists(i.path)] if package else []
+            book_title = os.path.splitext(os.path.basename(epub_path))[0]
+            for path in members or archive.html_members():
+                base_name = os.path.splitext(os.path.basename(path))[0]
+                docs.append((epub_path, path, base_name, book_title, archive.read_text(path)))
+    results = {}
+    for backend in backends:
+        if backend.name == "lxml":
+            legacy = lambda html, b=backend: _legacy_lxml_document(b, html)
+            parse = lambda html: backend._parse(html) is None
+        else:
+            legacy = _legacy_bs4_document
+            parse = lambda html: e2m.BeautifulSoup(html, "html.parser") is None
+        outputs = {}
+        timings = {}
+        # 各实现交替运行，计时期间关闭 GC（同 timeit），避免解析产生的大量对象让抖动偏向某一方
+        for _ in range(max(1, repeat)):
+            for label, fn in (("parse", parse), ("legacy", legacy), ("current", backend.document)):
+                outputs.pop(label, None)
+                gc.collect()
+                gc.disable()
+                try:
+                    dt, outputs[label] = _best_of(lambda fn=fn: [fn(d[4]) for d in docs], 1)
+                finally:
+                    gc.enable()
+                timings[label] = min(dt, timings.get(label, dt))
+        mismatches = []
+        for d, old, new in zip(docs, outputs["legacy"], outputs["current"]):
+            old_title = e2m._auto_chapter_title(old[1], old[2], d[2], d[3])
+            new_title = e2m._auto_chapter_title(new[1], new[2], d[2], d[3])
+            if old_title != new_title or old[:2] != new[:2] or str(old[2]) != str(new[2]):
+                mismatches.append((d[0], d[1], old_title, new_title))
+        # 解析耗时两者相同，扣除后才是标题检测与正文提取本身的差别
+        legacy_extract = max(timings["legacy"] - timings["parse"], 0.0)
+        current_extract = max(timings["current"] - timings["parse"], 0.0)
+        results[backend.name] = {
+            "documents": len(docs),
+            "mismatches": mismatches,
+            "parse_s": round(timings["parse"], 4),
+            "legacy_s": round(timings["legacy"], 4),
+            "current_s": round(timings["current"], 4),
+            "extract_speedup": round(legacy_extract / current_extract, 2) if current_extract else None,
+        }
+    return results
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="epub2markdown 基准测试")
+    parser.add_argument("--shapes", default=",".join(SHAPES),
+                        help=f"要运行的合成EPUB形状，逗号分隔（可选: {', '.join(SHAPES)}）")
+    parser.add_argument("--scale", type=float, default=1.0, help="合成EPUB的规模系数")
+    parser.add_argument("--repeat", type=int, default=1, help="每项取最好成绩的重复次数")
+    parser.add_argument("--text-backend", default="auto", help="HTML转文本后端 (auto/bs4/lxml)")
+    parser.add_argument("--keep-epubs", metavar="DIR", help="保留生成的合成EPUB到该目录")
+    parser.add_argument("--json", metavar="PATH", help="把结果写入JSON文件，便于跨提交比较")
+    parser.add_argument("--baseline", metavar="PATH", help="与此前保存的JSON结果比较，变差超过10%%时返回非零")
+    parser.add_argument("--compare-backends", nargs="+", metavar="EPUB",
+                        help="在给定样本书上验证 lxml 后端与 bs4 逐行一致")
+    parser.add_argument("--title-detection", nargs="*", metavar="EPUB",
+                        help="验证单次遍历的章节标题检测与旧实现一致；不给路径时使用 --shapes 生成的合成书")
+    args = parser.parse_args()
+
+    if args.compare_backends:
+        compared, mismatches, seconds = compare_text_backends(args.compare_backends)
+        print(f"比较了 {compared} 个文档；" + "，".join(f"{k}: {v:.3f}s" for k, v in seconds.items()))
+        for epub_path, path in mismatches:
+            print(f"不一致: {epub_path} :: {path}")
+        sys.exit(1 if mismatches else 0)
+
+    shapes = [s.strip() for s in args.shapes.split(",") if s.strip()]
+    unknown = [s for s in shapes if s not in SHAPES]
+    if unknown:
+        print(f"错误: 未知的形状: {', '.join(unknown)}")
+        sys.exit(2)
+
+    if args.title_detection is not None:
+        tmp = tempfile.mkdtemp(prefix="e2m-titles-")
+        try:
+            paths = args.title_detection or [make_shape(s, tmp, args.scale) for s in shapes]
+            exit_code = 0
+            for name, r in bench_title_detection(paths, args.repeat).items():
+                print(f"{name:<6} {r['documents']} 个文档：仅解析 {r['parse_s']:.4f}s，旧实现 {r['legacy_s']:.4f}s / "
+                      f"单次遍历 {r['current_s']:.4f}s" + (f" (解析之外 x{r['extract_speedup']})" if r["extract_speedup"] else ""))
+                for epub_path, path, old_title, new_title in r["mismatches"]:
+                    print(f"不一致: {epub_path} :: {path} ({old_title!r} -> {new_title!r})")
+                    exit_code = 1
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        sys.exit(exit_code)
+    results = run_suite(shapes, args.scale, args.repeat, args.text_backend, args.keep_epubs)
+
+    anchor = bench_anchor_segmentation(max(1, int(2000 * args.scale)), repeat=args.repeat)
+    results.append(anchor)
+    print(f"{'anchor_segmentation':<22} 旧实现 {anchor['legacy_locate_s']:.4f}s / 锚点索引 {anchor['index_locate_s']:.4f}s (x{anchor['speedup']})")
+
+    doc = {
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": args.scale,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(doc, f, ensure_ascii=False, indent=2)
+    exit_code = 0
+    if not anchor["positions_match"]:
+        print("错误: 锚点索引的定位结果与旧实现不一致。")
+        exit_code = 1
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare_results(json.load(f), doc)
+        for name, metric, ratio in regressions:
+            print(f"回退: {name} {metric} 变差 {ratio - 1:.1%}")
+        if regressions:
+            exit_code = 1
+    sys.exit(exit_code)
@@ -1,12 +1,240 @@
 import zipfile
 import os
-from bs4 import BeautifulSoup
+import hashlib
+import json
+import csv
+import uuid
+import posixpath
+from bs4 import BeautifulSoup, Tag, NavigableString, CData
+from bs4.dammit import EntitySubstitution
 import sys
-import tempfile
 import shutil
+import tempfile
+import time
+import contextlib
+import tracemalloc
+import threading
+import queue
+import tarfile
+import bisect
+import codecs
 import xml.etree.ElementTree as ET
 import re
 from urllib.parse import unquote
+from html import escape
+
+class _NullStats:
+    # 未开启统计时使用的空实现，stage() 返回同一个空上下文，几乎没有额外开销
+    enabled = False
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def add_bytes(self, read=0, written=0):
+        pass
+
+_NULL_STAGE = contextlib.nullcontext()
+_NULL_STATS = _NullStats()
+
+class _ConversionStats:
+    """
+    记录转换各阶段的耗时、读写字节数与峰值内存。
+    阶段可以嵌套，耗时按独占时间统计（进入子阶段时父阶段暂停计时）；
+    trace_memory 为 True 时用 tracemalloc 记录每个阶段的 Python 堆峰值，会拖慢转换。
+    进程的峰值 RSS 只增不减，同一进程先后转换多本书时无法归到某一本，因此只在批次汇总中报告。
+    """
+    enabled = True
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self._stack = []
+        self._started = time.perf_counter()
+        self._own_tracing = False
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._own_tracing = True
+
+    def _record(self, name):
+        rec = self.stages.get(name)
+        if rec is None:
+            rec = self.stages[name] = {"seconds": 0.0, "calls": 0, "bytes_read": 0, "bytes_written": 0}
+            if self.trace_memory:
+                rec["peak_traced_bytes"] = 0
+        return rec
+
+    def _note_peak(self, rec):
+        peak = tracemalloc.get_traced_memory()[1]
+        if peak > rec["peak_traced_bytes"]:
+            rec["peak_traced_bytes"] = peak
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        now = time.perf_counter()
+        if self._stack:
+            parent = self._stack[-1]
+            parent[1]["seconds"] += now - parent[2]
+            if self.trace_memory:
+                self._note_peak(parent[1])
+        rec = self._record(name)
+        rec["calls"] += 1
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        frame = [name, rec, now]
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self._stack.pop()
+            rec["seconds"] += now - frame[2]
+            if self.trace_memory:
+                self._note_peak(rec)
+            if self._stack:
+                self._stack[-1][2] = now
+
+    def add_bytes(self, read=0, written=0):
+        if self._stack:
+            rec = self._stack[-1][1]
+            rec["bytes_read"] += read
+            rec["bytes_written"] += written
+
+    def to_dict(self):
+        if self._own_tracing:
+            tracemalloc.stop()
+            self._own_tracing = False
+        stages = {}
+        for name, rec in self.stages.items():
+            stages[name] = dict(rec, seconds=round(rec["seconds"], 6))
+        return {
+            "wall_seconds": round(time.perf_counter() - self._started, 6),
+            "stages": stages,
+        }
+
+def _peak_rss_bytes(include_children=False):
+    # include_children 时取本进程与已结束的子进程（如进程池的工作进程）中最大的峰值
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if include_children:
+        rss = max(rss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    return rss if sys.platform == "darwin" else rss * 1024
+
+_STREAM_BLOCK_BYTES = 64 * 1024
+
+class _EpubArchive:
+    """
+    基于 zipfile 的只读虚拟文件系统。
+    路径均为压缩包内的 POSIX 路径，成员按需通过 ZipFile.open 读取，不落盘。
+    """
+    def __init__(self, epub_zip, stats=None):
+        self.zip = epub_zip
+        self.names = {n for n in epub_zip.namelist() if not n.endswith("/")}
+        self.stats = stats or _NULL_STATS
+
+    def exists(self, path):
+        return path in self.names
+
+    def open(self, path):
+        return self.zip.open(path, "r")
+
+    def read_bytes(self, path):
+        with self.stats.stage("unzip"):
+            with self.zip.open(path, "r") as f:
+                data = f.read()
+            self.stats.add_bytes(read=len(data))
+        return data
+
+    def read_text(self, path):
+        return self.read_bytes(path).decode("utf-8")
+
+    def size(self, path):
+        return self.zip.getinfo(path).file_size
+
+    def iter_text(self, path, digest=None, block_size=_STREAM_BLOCK_BYTES):
+        """按块解压并增量解码成员，任何时刻只持有一块；digest 非空时同时更新其哈希。"""
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        with self.zip.open(path, "r") as f:
+            while True:
+                with self.stats.stage("unzip"):
+                    block = f.read(block_size)
+                    self.stats.add_bytes(read=len(block))
+                if digest is not None:
+                    digest.update(block)
+                text = decoder.decode(block, final=not block)
+                if text:
+                    yield text
+                if not block:
+                    return
+
+    def sha256(self, path):
+        h = hashlib.sha256()
+        with self.zip.open(path, "r") as f:
+            for block in iter(lambda: f.read(_STREAM_BLOCK_BYTES), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    def find_opf(self):
+        # 优先通过 META-INF/container.xml 定位 rootfile
+        if self.exists("META-INF/container.xml"):
+            try:
+                with self.open("META-INF/container.xml") as f:
+                    r = ET.parse(f).getroot()
+                for el in r.iter():
+                    if el.tag.endswith("rootfile"):
+                        p = posixpath.normpath(unquote(el.attrib.get("full-path", "")))
+                        if p.endswith(".opf") and self.exists(p):
+                            return p
+            except Exception:
+                pass
+        for n in sorted(self.names):
+            if n.endswith(".opf"):
+                return n
+        return None
+
+    def html_members(self):
+        return sorted(n for n in self.names if n.endswith((".xhtml", ".html")))
+
+class _ArchiveLimitError(ValueError):
+    pass
+
+class _ArchiveLimits:
+    """
+    受限模式的上限配置。所有检查都基于 zip 中央目录中声明的大小，在读取任何成员之前完成；
+    ZipExtFile 解压时不会输出超过声明大小的数据（否则 CRC 校验失败），因此声明值可以作为硬上限。
+    chunk_chars 为单次交给 HTML 解析器的最大字符数，超过的 XHTML 按块处理。
+    """
+    __slots__ = ("max_total_bytes", "max_member_bytes", "max_members", "max_ratio", "chunk_chars")
+
+    def __init__(self, max_total_bytes=512 * 1024 * 1024, max_member_bytes=64 * 1024 * 1024, max_members=10000,
+                 max_ratio=100, chunk_chars=1024 * 1024):
+        self.max_total_bytes = max_total_bytes
+        self.max_member_bytes = max_member_bytes
+        self.max_members = max_members
+        self.max_ratio = max_ratio
+        self.chunk_chars = chunk_chars
+
+# 小文件的压缩比本身就可能很高（例如大量空白），只对超过该大小的成员检查压缩比
+_RATIO_CHECK_MIN_BYTES = 1024 * 1024
+
+def _check_archive_limits(epub_zip, limits):
+    infos = epub_zip.infolist()
+    if len(infos) > limits.max_members:
+        raise _ArchiveLimitError(f"成员数 {len(infos)} 超过上限 {limits.max_members}")
+    total = 0
+    for info in infos:
+        if info.file_size > limits.max_member_bytes:
+            raise _ArchiveLimitError(f"成员 {info.filename} 解压后 {info.file_size} 字节，超过上限 {limits.max_member_bytes}")
+        if info.file_size >= _RATIO_CHECK_MIN_BYTES and info.file_size > limits.max_ratio * max(info.compress_size, 1):
+            raise _ArchiveLimitError(f"成员 {info.filename} 压缩比超过 {limits.max_ratio}:1")
+        total += info.file_size
+    if total > limits.max_total_bytes:
+        raise _ArchiveLimitError(f"解压后总大小 {total} 字节，超过上限 {limits.max_total_bytes}")
+    return total
+
 def _short_title(t):
     t = re.sub(r"\s+", " ", t or "").strip()
     if not t:
@@ -25,14 +253,90 @@ def _resolve_href_to_path(href, base_dir):
         f, frag = href.split("#", 1)
     else:
         f, frag = href, None
-    p = os.path.normpath(os.path.join(base_dir, f))
+    p = posixpath.normpath(posixpath.join(base_dir, f))
     return p, frag
 
-def _parse_nav_xhtml(nav_path):
+class _ManifestItem:
+    __slots__ = ("id", "href", "path", "media_type", "properties")
+
+    def __init__(self, iid, href, path, media_type, properties):
+        self.id = iid
+        self.href = href
+        self.path = path
+        self.media_type = media_type
+        self.properties = properties
+
+class _Package:
+    """
+    OPF 包文件的索引结构，一次遍历构建。
+    by_id / by_path / by_media_type 为 manifest 索引（by_path 以压缩包内路径为键），
+    spine 为按阅读顺序排列的 _ManifestItem，nav / ncx 指向目录文件条目。
+    """
+    __slots__ = ("opf_path", "opf_dir", "title", "authors", "publisher",
+                 "by_id", "by_path", "by_media_type", "spine", "nav", "ncx")
+
+    def __init__(self, opf_path):
+        self.opf_path = opf_path
+        self.opf_dir = posixpath.dirname(opf_path)
+        self.title = None
+        self.authors = []
+        self.publisher = None
+        self.by_id = {}
+        self.by_path = {}
+        self.by_media_type = {}
+        self.spine = []
+        self.nav = None
+        self.ncx = None
+
+def _parse_package(archive, opf_path):
+    pkg = _Package(opf_path)
+    try:
+        with archive.open(opf_path) as f:
+            r = ET.parse(f).getroot()
+    except Exception:
+        return pkg
+    spine_ids = []
+    toc_id = None
+    for el in r.iter():
+        tag = el.tag
+        if tag.endswith("itemref"):
+            idref = el.attrib.get("idref")
+            if idref:
+                spine_ids.append(idref)
+        elif tag.endswith("item"):
+            iid = el.attrib.get("id")
+            href = el.attrib.get("href")
+            if not href:
+                continue
+            media_type = el.attrib.get("media-type", "")
+            props = el.attrib.get("properties", "")
+            path, _ = _resolve_href_to_path(href, pkg.opf_dir)
+            item = _ManifestItem(iid, href, path, media_type, props)
+            if iid:
+                pkg.by_id[iid] = item
+            pkg.by_path.setdefault(path, item)
+            pkg.by_media_type.setdefault(media_type, []).append(item)
+            if pkg.nav is None and "nav" in props.split():
+                pkg.nav = item
+            if pkg.ncx is None and media_type == "application/x-dtbncx+xml":
+                pkg.ncx = item
+        elif tag.endswith("spine"):
+            toc_id = el.attrib.get("toc")
+        elif tag.endswith("title") and el.text:
+            pkg.title = el.text.strip()
+        elif tag.endswith("creator") and el.text:
+            pkg.authors.append(el.text.strip())
+        elif tag.endswith("publisher") and el.text:
+            pkg.publisher = el.text.strip()
+    if pkg.ncx is None and toc_id:
+        pkg.ncx = pkg.by_id.get(toc_id)
+    pkg.spine = [pkg.by_id[i] for i in spine_ids if i in pkg.by_id]
+    return pkg
+
+def _parse_nav_xhtml(archive, nav_path):
     entries = []
-    base_dir = os.path.dirname(nav_path)
-    with open(nav_path, "r", encoding="utf-8") as f:
-        soup = BeautifulSoup(f, "html.parser")
+    base_dir = posixpath.dirname(nav_path)
+    soup = BeautifulSoup(archive.read_text(nav_path), "html.parser")
     nav = soup.find("nav", attrs={"epub:type": "toc"}) or soup.find("nav", attrs={"role": "doc-toc"}) or soup.find("nav", id="toc") or soup.find("nav")
     if not nav:
         return entries
@@ -51,11 +355,12 @@ def _parse_nav_xhtml(nav_path):
     walk(container)
     return entries
 
-def _parse_ncx(ncx_path):
+def _parse_ncx(archive, ncx_path):
     entries = []
-    base_dir = os.path.dirname(ncx_path)
+    base_dir = posixpath.dirname(ncx_path)
     try:
-        tree = ET.parse(ncx_path)
+        with archive.open(ncx_path) as f:
+            tree = ET.parse(f)
         r = tree.getroot()
         nav_map = None
         for el in r.iter():
@@ -88,72 +393,1866 @@ def _parse_ncx(ncx_path):
         return entries
     return entries
 
-def _get_toc_entries_from_opf(opf_path):
+def _get_toc_entries_from_opf(archive, package):
     entries = []
     try:
-        tree = ET.parse(opf_path)
-        r = tree.getroot()
-        opf_dir = os.path.dirname(opf_path)
-        nav_href = None
-        ncx_href = None
-        for el in r.iter():
-            if el.tag.endswith("item"):
-                href = el.attrib.get("href")
-                media_type = el.attrib.get("media-type", "")
-                props = el.attrib.get("properties", "")
-                if href and "nav" in props and not nav_href:
-                    nav_href = href
-                if href and media_type == "application/x-dtbncx+xml" and not ncx_href:
-                    ncx_href = href
-        if nav_href:
-            nav_path = os.path.join(opf_dir, nav_href)
-            if os.path.exists(nav_path):
-                entries = _parse_nav_xhtml(nav_path)
-        elif ncx_href:
-            ncx_path = os.path.join(opf_dir, ncx_href)
-            if os.path.exists(ncx_path):
-                entries = _parse_ncx(ncx_path)
+        if package.nav:
+            if archive.exists(package.nav.path):
+                entries = _parse_nav_xhtml(archive, package.nav.path)
+        elif package.ncx:
+            if archive.exists(package.ncx.path):
+                entries = _parse_ncx(archive, package.ncx.path)
     except Exception:
         entries = []
-    return [(p, frag, title) for (p, frag, title) in entries if p and p.lower().endswith((".xhtml", ".html")) and os.path.exists(p)]
+    return [(p, frag, title) for (p, frag, title) in entries if p and p.lower().endswith((".xhtml", ".html")) and archive.exists(p)]
+
+def _text_to_lines(text):
+    return [l.strip() for l in text.splitlines() if l.strip()]
+
+_HEADING_TAGS = frozenset(("h1", "h2", "h3", "h4", "h5", "h6"))
+_HEADING_AND_TITLE_TAGS = tuple(sorted(_HEADING_TAGS)) + ("title",)
+_MAIN_CONTENT_STRING_TYPES = {NavigableString, CData}
+
+class _Bs4TextBackend:
+    """
+    参考实现：BeautifulSoup + html.parser。
+    text() 等价于 get_text(separator="\\n", strip=True)；document() 额外返回标题候选
+    （h1-h6 的文本）与 <title> 的 string。
+    """
+    name = "bs4"
+
+    def text(self, html):
+        return BeautifulSoup(html, "html.parser").get_text(separator="\n", strip=True)
+
+    def document(self, html):
+        soup = BeautifulSoup(html, "html.parser")
+        # 一次遍历同时收集正文、h1-h6 与第一个 <title>，
+        # 结果与 get_text / find_all / soup.title 分别遍历整棵树时一致
+        types = soup.interesting_string_types or _MAIN_CONTENT_STRING_TYPES
+        if isinstance(types, type):
+            types = {types}
+        strings = []
+        headings = []
+        title_el = None
+        for node in soup.descendants:
+            if type(node) in types:
+                t = node.strip()
+                if t:
+                    strings.append(t)
+            elif isinstance(node, Tag):
+                if node.name in _HEADING_TAGS:
+                    headings.append(node.get_text(separator=" ", strip=True))
+                elif title_el is None and node.name == "title":
+                    title_el = node
+        page_title = title_el.string if title_el is not None else None
+        return "\n".join(strings), headings, page_title
 
-def _segment_file_by_toc(file_path, points):
-    with open(file_path, "r", encoding="utf-8") as f:
-        raw = f.read()
+# lxml 的 HTML 解析器按 HTML5 规则把这些元素的内容当作原始文本，
+# 自闭合写法 (<script/>) 会吞掉后续正文，需先展开成成对标签
+_RAW_TEXT_SELF_CLOSING_RE = re.compile(r"<(script|style|title|textarea|iframe|noscript|noembed|noframes|xmp)(\s[^<>]*?)?/>", re.I)
+_CDATA_RE = re.compile(r"<!\[CDATA\[(.*?)\]\]>", re.S)
+# html.parser 的实体规则：已知实体可省略分号，未知实体按字面量 "&name" 输出（分号被吞掉）
+_ENTITY_REF_RE = re.compile(r"&([a-zA-Z][-.a-zA-Z0-9]*)(?=[^a-zA-Z0-9])(;?)")
+# bs4 把 rt/rp（注音与注音括号）中的文本归为 RubyTextString / RubyParenthesisString，get_text 不输出
+_VISIBLE_TEXT_XPATH = ("text()[not(ancestor::script) and not(ancestor::style) and not(ancestor::template)"
+                       " and not(ancestor::rt) and not(ancestor::rp)]")
+
+class _LxmlTextBackend:
+    """
+    基于 lxml (libxml2) 的实现，输出与 _Bs4TextBackend 逐行一致：
+    跳过注释、处理指令以及 script/style/template/rt/rp 中的文本，CDATA 按普通文本处理。
+    libxml2 在超出资源上限（嵌套超过 2048 层等）时会中途停止解析，这类文档交给 bs4 处理。
+    """
+    name = "lxml"
+
+    def __init__(self):
+        from lxml import etree
+        self._etree = etree
+        # huge_tree 解除单个文本节点 10MB、嵌套 256 层等默认上限
+        self._parser = etree.HTMLParser(encoding="utf-8", huge_tree=True)
+        self._all_text = etree.XPath("//" + _VISIBLE_TEXT_XPATH, smart_strings=False)
+        self._node_text = etree.XPath(".//" + _VISIBLE_TEXT_XPATH, smart_strings=False)
+        self._fallback = None
+
+    @staticmethod
+    def _entity_ref(m):
+        if m.group(1) in EntitySubstitution.HTML_ENTITY_TO_CHARACTER:
+            return f"&{m.group(1)};"
+        return f"&amp;{m.group(1)}"
+
+    def _parse(self, html):
+        html = _RAW_TEXT_SELF_CLOSING_RE.sub(r"<\1\2></\1>", html)
+        escaped = []
+        if "<![CDATA[" in html:
+            # 先把 CDATA 转义成普通文本并包一层元素，保证与 bs4 一样成为独立的文本节点；
+            # 记下这些区间，下面的实体修正不再处理其中已转义的内容
+            parts = _CDATA_RE.split(html)
+            pos = 0
+            for i in range(1, len(parts), 2):
+                pos += len(parts[i-1])
+                parts[i] = f"<span>{escape(parts[i], quote=False)}</span>"
+                escaped.append((pos, pos + len(parts[i])))
+                pos += len(parts[i])
+            html = "".join(parts)
+        if "&" in html:
+            if escaped:
+                starts = [a for a, _ in escaped]
+
+                def entity_ref(m):
+                    i = bisect.bisect_right(starts, m.start()) - 1
+                    if i >= 0 and m.start() < escaped[i][1]:
+                        return m.group(0)
+                    return self._entity_ref(m)
+
+                html = _ENTITY_REF_RE.sub(entity_ref, html)
+            else:
+                html = _ENTITY_REF_RE.sub(self._entity_ref, html)
+        try:
+            return self._etree.fromstring(html.encode("utf-8"), self._parser)
+        except self._etree.XMLSyntaxError:
+            return None
+
+    def _truncated(self):
+        # 上一次解析是否因 libxml2 的资源上限而中途停止（只记录 FATAL 错误，不抛异常）
+        return bool(self._parser.error_log.filter_from_fatals())
+
+    def _bs4(self):
+        if self._fallback is None:
+            self._fallback = _Bs4TextBackend()
+        return self._fallback
+
+    @staticmethod
+    def _join(strings, sep):
+        return sep.join(t for t in (s.strip() for s in strings) if t)
+
+    def text(self, html):
+        root = self._parse(html)
+        if self._truncated():
+            return self._bs4().text(html)
+        if root is None:
+            return ""
+        return self._join(self._all_text(root), "\n")
+
+    def document(self, html):
+        root = self._parse(html)
+        if self._truncated():
+            return self._bs4().document(html)
+        if root is None:
+            return "", [], None
+        text = self._join(self._all_text(root), "\n")
+        # h1-h6 与第一个 <title> 在同一次元素遍历中收集
+        # （合并成一条 XPath 并集反而更慢：libxml2 要对结果按文档顺序排序）
+        headings = []
+        el = None
+        for node in root.iter(*_HEADING_AND_TITLE_TAGS):
+            if node.tag != "title":
+                headings.append(self._join(self._node_text(node), " "))
+            elif el is None:
+                el = node
+        page_title = None
+        # 对齐 bs4 Tag.string：仅有唯一子节点时才有值
+        while el is not None:
+            children = list(el)
+            if not children:
+                page_title = el.text
+                break
+            if len(children) == 1 and not el.text and not children[0].tail and isinstance(children[0].tag, str):
+                el = children[0]
+            else:
+                break
+        return text, headings, page_title
+
+_TEXT_BACKENDS = {
+    "bs4": _Bs4TextBackend,
+    "lxml": _LxmlTextBackend,
+}
+
+def _get_text_backend(name=None):
+    # auto: 安装了 lxml 时使用 lxml，否则退回 bs4
+    if name in (None, "auto"):
+        try:
+            import lxml.etree
+            name = "lxml"
+        except ImportError:
+            name = "bs4"
+    if name not in _TEXT_BACKENDS:
+        raise ValueError(f"未知的文本提取后端: {name}")
+    return _TEXT_BACKENDS[name]()
+
+# 分块时只在这些块级元素的结束标签之后切开，保证不会把一个文本节点切成两半
+_CHUNK_CUT_RE = re.compile(r"</(?:p|div|h[1-6]|li|tr|table|section|article|blockquote|pre|ul|ol|dl|figure)\s*>", re.I)
+# 注释、CDATA 与原始文本元素内部不能切开，否则其内容会在下一块中变成可见正文
+_CHUNK_UNSAFE_RE = re.compile(r"<!--.*?-->|<!\[CDATA\[.*?\]\]>|<(script|style|textarea|title|template)\b.*?</\1\s*>",
+                              re.S | re.I)
+
+_CHUNK_UNSAFE_OPEN_RE = re.compile(r"<!--|<!\[CDATA\[|<(?:script|style|textarea|title|template)\b", re.I)
+
+def _unsafe_spans(html, final=True):
+    # 与 _CHUNK_UNSAFE_RE.finditer 的结果相同；final 为 False 时 html 只是前缀，
+    # 尚未闭合的注释或原始文本元素视为延伸到末尾之后（恰好落在末尾的切点也不安全）
+    spans = []
+    pos = 0
+    while True:
+        m = _CHUNK_UNSAFE_OPEN_RE.search(html, pos)
+        if not m:
+            return spans
+        full = _CHUNK_UNSAFE_RE.match(html, m.start())
+        if full:
+            spans.append((full.start(), full.end()))
+            pos = full.end()
+        elif not final:
+            spans.append((m.start(), len(html) + 1))
+            return spans
+        else:
+            pos = m.start() + 1
+
+def _iter_html_chunks(html, chunk_chars, final=True):
+    """
+    把超大 HTML 在安全的块级边界切成约 chunk_chars 大小的片段；找不到边界时整段返回。
+    final 为 False 时 html 只是流的前缀，最后一段是尚未切分的剩余部分。
+    """
+    start = 0
+    n = len(html)
+    unsafe = _unsafe_spans(html, final)
+    u = 0
+    while n - start > chunk_chars:
+        cut = None
+        for m in _CHUNK_CUT_RE.finditer(html, start + chunk_chars):
+            pos = m.end()
+            while u < len(unsafe) and unsafe[u][1] <= pos:
+                u += 1
+            if u < len(unsafe) and unsafe[u][0] < pos:
+                continue
+            cut = pos
+            break
+        if cut is None:
+            break
+        yield html[start:cut]
+        start = cut
+    yield html[start:]
+
+def _iter_html_chunks_stream(pieces, chunk_chars):
+    """
+    对逐块解码出的文本流做与 _iter_html_chunks 等价的切分：缓冲区每增长 chunk_chars 尝试切出前面的块，
+    内存只与块大小（以及最长的不可切开区域）有关，不需要把整个成员读入内存。
+    """
+    buf = ""
+    next_try = 2 * chunk_chars
+    for piece in pieces:
+        buf += piece
+        if len(buf) < next_try:
+            continue
+        chunks = list(_iter_html_chunks(buf, chunk_chars, final=False))
+        buf = chunks.pop()
+        yield from chunks
+        next_try = len(buf) + chunk_chars
+    yield from _iter_html_chunks(buf, chunk_chars)
+
+class _ChunkedTextBackend:
+    """
+    受限模式下包装文本后端：超过 chunk_chars 的文档按块解析再拼接，单次解析树的大小有上限。
+    由于只在块级结束标签处切开，结果与整篇解析一致。
+    """
+    def __init__(self, inner, chunk_chars):
+        self.inner = inner
+        self.name = inner.name
+        self.chunk_chars = chunk_chars
+
+    def text(self, html):
+        if len(html) <= self.chunk_chars:
+            return self.inner.text(html)
+        return "\n".join(t for t in (self.inner.text(c) for c in _iter_html_chunks(html, self.chunk_chars)) if t)
+
+    def document(self, html):
+        if len(html) <= self.chunk_chars:
+            return self.inner.document(html)
+        return self.document_chunks(_iter_html_chunks(html, self.chunk_chars))
+
+    def document_chunks(self, chunks):
+        texts, headings, page_title = [], [], None
+        for chunk in chunks:
+            text, chunk_headings, chunk_title = self.inner.document(chunk)
+            if text:
+                texts.append(text)
+            headings.extend(chunk_headings)
+            if page_title is None:
+                page_title = chunk_title
+        return "\n".join(texts), headings, page_title
+
+_ANCHOR_ATTR_RE = re.compile(r"""\b(id|name)\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+
+def _build_anchor_index(raw):
+    # 单次扫描，记录每个 id / name 属性值首次出现的位置（id 包含 xml:id）
+    ids = {}
+    names = {}
+    for m in _ANCHOR_ATTR_RE.finditer(raw):
+        value = m.group(2) if m.group(2) is not None else m.group(3)
+        target = ids if m.group(1) == "id" else names
+        if value not in target:
+            target[value] = m.start()
+    return ids, names
+
+def _locate_toc_points(raw, points):
+    index = None
+    if any(frag for _, frag, _ in points):
+        index = _build_anchor_index(raw)
     positions = []
     for gid, frag, title in points:
         pos = None
         if frag:
-            pats = [
-                rf'id\s*=\s*"{re.escape(frag)}"',
-                rf"id\s*=\s*'{re.escape(frag)}'",
-                rf'name\s*=\s*"{re.escape(frag)}"',
-                rf"name\s*=\s*'{re.escape(frag)}'",
-                rf'xml:id\s*=\s*"{re.escape(frag)}"',
-                rf"xml:id\s*=\s*'{re.escape(frag)}'",
-            ]
-            for pat in pats:
-                m = re.search(pat, raw)
-                if m:
-                    s = m.start()
-                    tag_open = raw.rfind("<", 0, s)
-                    pos = tag_open if tag_open != -1 else s
-                    break
+            ids, names = index
+            s = ids.get(frag)
+            if s is None:
+                s = names.get(frag)
+            if s is not None:
+                tag_open = raw.rfind("<", 0, s)
+                pos = tag_open if tag_open != -1 else s
         if pos is None:
             pos = 0
         positions.append((gid, title, frag, pos))
     positions.sort(key=lambda x: x[3])
+    return positions
+
+# 插入到切分点的私有区字符标记，整文件只解析一次，再按标记切分文本
+_SEGMENT_MARK = "\ue000\ue001\ue000"
+
+def _segment_html_by_toc(raw, points, backend=None, stats=None):
+    backend = backend or _Bs4TextBackend()
+    stats = stats or _NULL_STATS
+    with stats.stage("segment"):
+        positions = _locate_toc_points(raw, points)
+        cuts = [pos for _, _, _, pos in positions if pos > 0]
+        marked = None
+        if _SEGMENT_MARK not in raw:
+            pieces = []
+            last = 0
+            for pos in cuts:
+                pieces.append(raw[last:pos])
+                pieces.append(_SEGMENT_MARK)
+                last = pos
+            pieces.append(raw[last:])
+            marked = "".join(pieces)
+    parts = None
+    if marked is not None:
+        with stats.stage("html_to_text"):
+            parts = backend.text(marked).split(_SEGMENT_MARK)
+        # 标记落入 script/style 等不可见区域时数量对不上，退回逐段解析
+        if len(parts) != len(cuts) + 1:
+            parts = None
     segments = []
+    k = 0
     for i, (gid, title, frag, start_pos) in enumerate(positions):
         end_pos = positions[i+1][3] if i+1 < len(positions) else len(raw)
-        segment_html = raw[start_pos:end_pos]
-        seg_soup = BeautifulSoup(segment_html, "html.parser")
-        seg_text = seg_soup.get_text(separator="\n", strip=True)
-        lines = [l.strip() for l in seg_text.splitlines() if l.strip()]
+        if start_pos > 0:
+            k += 1
+        if end_pos == start_pos:
+            lines = []
+        elif parts is not None:
+            lines = _text_to_lines(parts[k])
+        else:
+            with stats.stage("html_to_text"):
+                lines = _text_to_lines(backend.text(raw[start_pos:end_pos]))
+        segments.append((gid, title, lines))
+    return segments
+
+def _locate_toc_points_in_chunks(chunks, points):
+    """与 _locate_toc_points 的结果相同，但逐块扫描，位置为整篇中的偏移；块须来自安全边界切分。"""
+    ids = {}
+    names = {}
+    off = 0
+    last_lt = -1
+    for chunk in chunks:
+        for m in _ANCHOR_ATTR_RE.finditer(chunk):
+            value = m.group(2) if m.group(2) is not None else m.group(3)
+            target = ids if m.group(1) == "id" else names
+            if value not in target:
+                lt = chunk.rfind("<", 0, m.start())
+                target[value] = off + lt if lt != -1 else (last_lt if last_lt != -1 else off + m.start())
+        lt = chunk.rfind("<")
+        if lt != -1:
+            last_lt = off + lt
+        off += len(chunk)
+    positions = []
+    for gid, frag, title in points:
+        pos = None
+        if frag:
+            pos = ids.get(frag)
+            if pos is None:
+                pos = names.get(frag)
+        positions.append((gid, title, frag, pos or 0))
+    positions.sort(key=lambda x: x[3])
+    return positions
+
+def _segment_chunks_by_toc(chunks, positions, backend, stats=None):
+    """
+    _segment_html_by_toc 的流式版本：positions 来自 _locate_toc_points_in_chunks（对同一块序列），
+    每块插入落在其中的切分标记后解析一次，各段文本跨块拼接，结果与整篇处理一致。
+    """
+    stats = stats or _NULL_STATS
+    cuts = [pos for _, _, _, pos in positions if pos > 0]
+    texts = [[] for _ in range(len(cuts) + 1)]
+    k = 0
+    c = 0
+    off = 0
+    for chunk in chunks:
+        end = off + len(chunk)
+        local = []
+        while c < len(cuts) and cuts[c] < end:
+            local.append(cuts[c] - off)
+            c += 1
+        with stats.stage("html_to_text"):
+            parts = None
+            if not local:
+                parts = [backend.text(chunk)]
+            elif _SEGMENT_MARK not in chunk:
+                pieces = []
+                last = 0
+                for pos in local:
+                    pieces.append(chunk[last:pos])
+                    pieces.append(_SEGMENT_MARK)
+                    last = pos
+                pieces.append(chunk[last:])
+                parts = backend.text("".join(pieces)).split(_SEGMENT_MARK)
+                # 标记落入 script/style 等不可见区域时数量对不上，退回逐段解析
+                if len(parts) != len(local) + 1:
+                    parts = None
+            if parts is None:
+                bounds = [0] + local + [len(chunk)]
+                parts = [backend.text(chunk[a:b]) if b > a else "" for a, b in zip(bounds, bounds[1:])]
+        texts[k].append(parts[0])
+        for part in parts[1:]:
+            k += 1
+            texts[k].append(part)
+        off = end
+    segments = []
+    k = 0
+    for i, (gid, title, frag, start_pos) in enumerate(positions):
+        end_pos = positions[i+1][3] if i+1 < len(positions) else off
+        if start_pos > 0:
+            k += 1
+        lines = [] if end_pos == start_pos else _text_to_lines("\n".join(texts[k]))
         segments.append((gid, title, lines))
     return segments
 
-def convert_epub_to_markdown(epub_file_path, base_output_folder):
+def _segment_file_by_toc(archive, file_path, points, backend=None):
+    return _segment_html_by_toc(archive.read_text(file_path), points, backend, archive.stats)
+
+# 缓存格式版本；提取逻辑或缓存内容结构变化时递增，使旧缓存失效
+_CACHE_VERSION = 2
+_BOOK_MANIFEST_NAME = ".epub2md-manifest.json"
+# 影响输出内容的选项，记录在书籍清单中；旧清单缺少的项按默认值比较
+_DEFAULT_OUTPUT_OPTIONS = {"text_backend": None, "records": None, "book_id": None, "title_rules": None, "tts": False,
+                           "images": None, "analytics": False}
+_DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# 本进程新写入的缓存条目累计超过上限的这一比例时才扫描缓存目录做淘汰
+_CACHE_EVICT_FRACTION = 0.1
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _write_json_atomic(path, obj):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def _read_book_manifest(output_dir, bundle=None):
+    try:
+        if bundle:
+            data = _read_bundle_member(_bundle_path(output_dir, bundle),
+                                       f"{os.path.basename(output_dir)}/{_BOOK_MANIFEST_NAME}")
+            manifest = json.loads(data) if data else None
+        else:
+            with open(os.path.join(output_dir, _BOOK_MANIFEST_NAME), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get("version") != _CACHE_VERSION:
+        return None
+    return manifest
+
+class _ConversionCache:
+    """
+    按内容寻址的提取结果缓存，可在整个书库间共享。
+    键为 spine 成员内容的 sha256 加上影响提取结果的参数；条目为 JSON 文件，
+    命中时刷新 mtime，evict() 按 mtime 做 LRU 淘汰直到总大小不超过 max_bytes。
+    evict() 要遍历整个缓存目录，每本书之后调用的是 maybe_evict()：只有本进程写入的新条目足够多时才真正淘汰。
+    """
+    # 按缓存目录记录本进程自上次淘汰以来写入的字节数；进程池的工作进程跨任务保留
+    _written_since_evict = {}
+
+    def __init__(self, cache_dir, max_bytes=_DEFAULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(kind, member_hash, params=None):
+        raw = json.dumps([_CACHE_VERSION, kind, member_hash, params], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_json_atomic(path, value)
+            written = self._written_since_evict
+            written[self.cache_dir] = written.get(self.cache_dir, 0) + os.path.getsize(path)
+        except OSError:
+            pass
+
+    def maybe_evict(self):
+        if self._written_since_evict.get(self.cache_dir, 0) < self.max_bytes * _CACHE_EVICT_FRACTION:
+            return 0
+        return self.evict()
+
+    def evict(self):
+        self._written_since_evict[self.cache_dir] = 0
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                p = os.path.join(root, name)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, p))
+                total += st.st_size
+        if total <= self.max_bytes:
+            return 0
+        removed = 0
+        for _, size, p in sorted(entries):
+            try:
+                os.remove(p)
+            except OSError:
+                continue
+            removed += 1
+            total -= size
+            if total <= self.max_bytes:
+                break
+        return removed
+
+def _auto_chapter_title(headings, page_title, base_name, book_title):
+    book_title_lower = book_title.strip().lower()
+    cand = []
+    for t in headings:
+        if t:
+            t = re.sub(r"\s+", " ", t).strip()
+            cand.append(t)
+    cand = [t for t in cand if t.lower() != book_title_lower and t.lower() not in ("contents", "table of contents")]
+    auto_title = None
+    if cand:
+        t0 = cand[0]
+        if re.fullmatch(r"\d{1,3}", t0) or re.fullmatch(r"[IVXLCDM]+", t0):
+            if len(cand) >= 2 and len(cand[1]) > 2:
+                auto_title = f"{t0} {cand[1]}"
+            else:
+                auto_title = t0
+        else:
+            auto_title = t0
+    if not auto_title and page_title:
+        t = re.sub(r"\s+", " ", page_title).strip()
+        if t and t.lower() != book_title_lower:
+            auto_title = t
+    if not auto_title:
+        auto_title = base_name
+    return auto_title
+
+def _iter_chapters(archive, content_files, toc_entries, book_title, backend, cache=None, force=False, cache_info=None,
+                   stats=None, image_refs=None):
+    """
+    逐个 spine 成员提取章节，按输出顺序产出 (序号, 成员路径, 自动标题, 行列表)。
+    有目录时按目录条目切分，否则每个内容文件一章。每次只持有一个成员的内容。
+    cache_info (dict): 启用缓存时记录成员哈希 (members) 与复用的成员数 (reused)。
+    image_refs (dict): 非 None 时同时定位正文中的图片，按章节序号记录 [(图片之前的正文行数, 图片路径)]。
+    """
+    stats = stats or _NULL_STATS
+    if cache_info is None:
+        cache_info = {"members": {}, "reused": 0}
+    with_images = image_refs is not None
+    # 带图片标记的提取结果与普通结果分开缓存
+    kind_suffix = ":images" if with_images else ""
+
+    def decode(data, member_path):
+        raw = data.decode("utf-8")
+        return _mark_images(raw, member_path) if with_images else raw
+
+    # 受限模式下超过单块大小的成员不整体读入：边解压边解码、按安全边界切块，每块单独处理
+    chunk_chars = backend.chunk_chars if isinstance(backend, _ChunkedTextBackend) else None
+
+    def streamed(member_path):
+        return chunk_chars is not None and archive.size(member_path) > chunk_chars
+
+    def stream_chunks(member_path, digest=None):
+        chunks = _iter_html_chunks_stream(archive.iter_text(member_path, digest), chunk_chars)
+        return (_mark_images(c, member_path) for c in chunks) if with_images else chunks
+
+    def take_images(idx, lines):
+        if not with_images:
+            return lines
+        lines, refs = _split_image_marks(lines)
+        if refs:
+            image_refs[idx] = refs
+        return lines
+    if toc_entries:
+        gid = 1
+        groups = {}
+        order_files = []
+        for p, frag, title in toc_entries:
+            if archive.exists(p) and p.lower().endswith(('.xhtml', '.html')):
+                if p not in groups:
+                    groups[p] = []
+                    order_files.append(p)
+                groups[p].append((gid, frag, title))
+                gid += 1
+        for fp in order_files:
+            points = groups.get(fp, [])
+            # 缓存中以文件内的序号代替全书 gid，前面章节增删时仍可复用
+            local_points = [(i, frag, title) for i, (_, frag, title) in enumerate(points)]
+            data = None
+            positions = None
+            if streamed(fp):
+                # 第一遍建立锚点索引（同时计算成员哈希），第二遍才逐块解析
+                digest = hashlib.sha256() if cache else None
+                with stats.stage("segment"):
+                    positions = _locate_toc_points_in_chunks(stream_chunks(fp, digest), local_points)
+                member_hash = digest.hexdigest() if digest else None
+            else:
+                data = archive.read_bytes(fp)
+                member_hash = hashlib.sha256(data).hexdigest() if cache else None
+            segs = None
+            if cache:
+                with stats.stage("cache"):
+                    cache_info["members"][fp] = member_hash
+                    key = cache.key("toc" + kind_suffix, cache_info["members"][fp],
+                                    [backend.name, [[frag, title] for _, frag, title in local_points]])
+                    segs = None if force else cache.get(key)
+                if segs is not None:
+                    cache_info["reused"] += 1
+            if segs is None:
+                if positions is not None:
+                    segs = _segment_chunks_by_toc(stream_chunks(fp), positions, backend, stats)
+                else:
+                    segs = _segment_html_by_toc(decode(data, fp), local_points, backend, stats)
+                if cache:
+                    with stats.stage("cache"):
+                        cache.put(key, segs)
+            del data
+            for i, title, lines in segs:
+                yield points[i][0], fp, title, take_images(points[i][0], lines)
+    else:
+        for idx, item_path in enumerate(content_files, 1):
+            data = None if streamed(item_path) else archive.read_bytes(item_path)
+            extracted = None
+            if cache:
+                with stats.stage("cache"):
+                    cache_info["members"][item_path] = (archive.sha256(item_path) if data is None
+                                                        else hashlib.sha256(data).hexdigest())
+                    key = cache.key("document" + kind_suffix, cache_info["members"][item_path], [backend.name])
+                    extracted = None if force else cache.get(key)
+                if extracted is not None:
+                    cache_info["reused"] += 1
+            if extracted is None:
+                with stats.stage("html_to_text"):
+                    if data is None:
+                        text_content, headings, page_title = backend.document_chunks(stream_chunks(item_path))
+                    else:
+                        text_content, headings, page_title = backend.document(decode(data, item_path))
+                    extracted = [_text_to_lines(text_content), headings, str(page_title) if page_title else None]
+                if cache:
+                    with stats.stage("cache"):
+                        cache.put(key, extracted)
+            del data
+            lines, headings, page_title = extracted
+            if with_images:
+                headings = [_IMAGE_MARK_RE.sub("", h) for h in headings]
+                page_title = _IMAGE_MARK_RE.sub("", page_title) if page_title else page_title
+            base_name = posixpath.splitext(posixpath.basename(item_path))[0]
+            yield idx, item_path, _auto_chapter_title(headings, page_title, base_name, book_title), take_images(idx, lines)
+
+# 图片标记：在每个 <img>/<image> 标签之后插入 "\ue002路径\ue003"，随正文一起提取后再换算成行位置；
+# 标记总是位于标签后的文本节点开头，去掉后各行与不插入标记时完全一致
+_IMAGE_MARK_OPEN = "\ue002"
+_IMAGE_MARK_CLOSE = "\ue003"
+_IMAGE_MARK_RE = re.compile(f"{_IMAGE_MARK_OPEN}([^{_IMAGE_MARK_CLOSE}]*){_IMAGE_MARK_CLOSE}")
+_IMAGE_TAG_RE = re.compile(r"<(?:img|image)\b[^>]*>", re.I)
+_IMAGE_SRC_RE = re.compile(r"""(?<![-\w])(?:src|xlink:href|href)\s*=\s*(?:"([^"]*)"|'([^']*)')""", re.I)
+_IMAGE_WEB_SIZE = 1280
+_IMAGE_THUMB_SIZE = 320
+
+def _mark_images(raw, member_path):
+    base_dir = posixpath.dirname(member_path)
+
+    def repl(m):
+        src = _IMAGE_SRC_RE.search(m.group(0))
+        href = (src.group(1) if src.group(1) is not None else src.group(2)).strip() if src else ""
+        if not href or href.startswith(("data:", "http:", "https:")):
+            return m.group(0)
+        path, _ = _resolve_href_to_path(href, base_dir)
+        return f"{m.group(0)}{_IMAGE_MARK_OPEN}{escape(path)}{_IMAGE_MARK_CLOSE}"
+
+    return _IMAGE_TAG_RE.sub(repl, raw)
+
+def _split_image_marks(lines):
+    """去掉行中的图片标记，返回 (正文行, [(图片之前的正文行数, 压缩包内路径)])。"""
+    clean = []
+    refs = []
+    for line in lines:
+        if _IMAGE_MARK_OPEN not in line:
+            clean.append(line)
+            continue
+        for m in _IMAGE_MARK_RE.finditer(line):
+            refs.append((len(clean), m.group(1)))
+        rest = _IMAGE_MARK_RE.sub("", line).strip()
+        if rest:
+            clean.append(rest)
+    return clean, refs
+
+def _load_pil():
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    return Image
+
+class _ImageStore:
+    """
+    全库共享的图片目录：原图按内容 SHA-256 存为 ab/<hash>.<ext>，跨书、跨章节只保存一份。
+    安装了 Pillow 时在线程池中生成网页尺寸 (_web) 与缩略图 (_thumb) 变体，已存在的文件不会重复生成；
+    未安装时只保存原图。写入都经过临时文件再改名，多个进程同时转换也不会留下半截文件。
+    """
+    def __init__(self, root, workers=None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.root = root
+        self.Image = _load_pil()
+        self.executor = ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1))
+        self._pending = []
+        self._known = {}
+        self.stored = 0
+        self.reused = 0
+        self.failed = 0
+
+    def _write(self, rel_path, data):
+        path = os.path.join(self.root, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def add(self, archive, member_path):
+        if member_path in self._known:
+            return self._known[member_path]
+        record = None
+        if archive.exists(member_path):
+            data = archive.read_bytes(member_path)
+            digest = hashlib.sha256(data).hexdigest()
+            ext = posixpath.splitext(member_path)[1].lower() or ".bin"
+            stem = f"{digest[:2]}/{digest}"
+            record = {"hash": digest, "src": member_path, "bytes": len(data), "original": stem + ext}
+            if os.path.exists(os.path.join(self.root, record["original"])):
+                self.reused += 1
+            else:
+                self._write(record["original"], data)
+                self.stored += 1
+            if self.Image and ext != ".svg":
+                self._add_variants(record, stem, data)
+        self._known[member_path] = record
+        return record
+
+    def _add_variants(self, record, stem, data):
+        import io
+        try:
+            # Image.open 只解析文件头，尺寸与模式可以同步拿到，解码与缩放放进线程池
+            with self.Image.open(io.BytesIO(data)) as im:
+                record["width"], record["height"] = im.size
+                alpha = im.mode in ("RGBA", "LA", "P") and (im.mode != "P" or "transparency" in im.info)
+        except Exception:
+            self.failed += 1
+            return
+        fmt, ext = ("PNG", ".png") if alpha else ("JPEG", ".jpg")
+        jobs = []
+        for kind, size in (("web", _IMAGE_WEB_SIZE), ("thumb", _IMAGE_THUMB_SIZE)):
+            rel = f"{stem}_{kind}{ext}"
+            record[kind] = rel
+            if not os.path.exists(os.path.join(self.root, rel)):
+                jobs.append((rel, size))
+        if jobs:
+            self._pending.append(self.executor.submit(self._render_variants, data, fmt, alpha, jobs))
+
+    def _render_variants(self, data, fmt, alpha, jobs):
+        import io
+        with self.Image.open(io.BytesIO(data)) as im:
+            # JPEG 可以在解码时直接按 1/2、1/4、1/8 缩小，大图省去大部分解码开销
+            largest = max(size for _, size in jobs)
+            im.draft("RGB", (largest, largest))
+            im = im.convert("RGBA" if alpha else "RGB")
+            for rel, size in sorted(jobs, key=lambda j: -j[1]):
+                im.thumbnail((size, size))
+                buf = io.BytesIO()
+                im.save(buf, fmt, **({"quality": 82, "optimize": True} if fmt == "JPEG" else {"optimize": True}))
+                self._write(rel, buf.getvalue())
+
+    def close(self):
+        for fut in self._pending:
+            try:
+                fut.result()
+            except Exception as e:
+                self.failed += 1
+                print(f"警告: 生成图片缩略图失败: {e}")
+        self._pending = []
+        self.executor.shutdown()
+
+def _write_image_index(output, md_file_path, chapter_index, title_text, images, images_root):
+    """
+    写出一章的图片索引（与章节文件同名，扩展名 .images.json）。
+    after_line 为图片之前的正文行数（0 表示章首）；各文件路径相对 root，root 相对本索引所在目录。
+    """
+    path = md_file_path[:-len(".md")] + ".images.json"
+    root = os.path.relpath(images_root, os.path.dirname(md_file_path)).replace(os.sep, "/")
+    output.write(os.path.basename(path), json.dumps({"chapter": chapter_index, "title": title_text, "root": root,
+                                                     "images": images}, ensure_ascii=False))
+    return path
+
+_RECORDS_FORMATS = ("ndjson", "csv")
+_NORMALIZE_WS_RE = re.compile(r"\s+")
+
+def _normalize_paragraph(text):
+    # 与 src/utils/mdParser.ts 的 normalizeText 一致
+    text = text.replace("\r", " ").replace("\t", " ").replace("\u00a0", " ")
+    return _NORMALIZE_WS_RE.sub(" ", text).strip()
+
+class _RecordsWriter:
+    """
+    按数据库 chapters / paragraphs 表结构流式写出预先分好段的记录，order_index 从 1 开始，
+    与网页端导入时的编号一致；每行正文为一个段落，没有段落的章节跳过。
+    ndjson: 单个文件，每行一条 {"table": ..., 各列}；
+    csv: books / chapters / paragraphs 三个可直接 COPY 的 CSV，外加 copy.sql。
+    id 预先生成，book_id 可由调用方指定，以便整本书一次性批量导入。
+    """
+    def __init__(self, output_dir, base_name, fmt, book_title, author=None, book_id=None):
+        if fmt not in _RECORDS_FORMATS:
+            raise ValueError(f"未知的记录格式: {fmt}")
+        self.fmt = fmt
+        self.book_id = book_id or str(uuid.uuid4())
+        self.chapter_count = 0
+        self.paragraph_count = 0
+        self.paths = []
+        self._files = []
+        book_row = {"id": self.book_id, "title": book_title, "author": author or None}
+        if fmt == "ndjson":
+            path = os.path.join(output_dir, f"{base_name}_records.ndjson")
+            self._ndjson = self._open(path)
+            self._emit_ndjson("books", book_row)
+        else:
+            books_path = os.path.join(output_dir, f"{base_name}_books.csv")
+            chapters_path = os.path.join(output_dir, f"{base_name}_chapters.csv")
+            paragraphs_path = os.path.join(output_dir, f"{base_name}_paragraphs.csv")
+            books = csv.writer(self._open(books_path), lineterminator="\n")
+            books.writerow(["id", "title", "author"])
+            books.writerow([book_row["id"], book_row["title"], book_row["author"] or ""])
+            self._chapters = csv.writer(self._open(chapters_path), lineterminator="\n")
+            self._chapters.writerow(["id", "book_id", "title", "order_index"])
+            self._paragraphs = csv.writer(self._open(paragraphs_path), lineterminator="\n")
+            self._paragraphs.writerow(["chapter_id", "content", "order_index"])
+            sql_path = os.path.join(output_dir, f"{base_name}_copy.sql")
+            with open(sql_path, "w", encoding="utf-8") as f:
+                f.write("-- 在 psql 中执行；books 需补充 user_id 后再导入\n")
+                f.write(f"\\copy chapters (id, book_id, title, order_index) FROM '{os.path.basename(chapters_path)}' WITH (FORMAT csv, HEADER true)\n")
+                f.write(f"\\copy paragraphs (chapter_id, content, order_index) FROM '{os.path.basename(paragraphs_path)}' WITH (FORMAT csv, HEADER true)\n")
+            self.paths.append(sql_path)
+
+    def _open(self, path):
+        f = open(path, "w", encoding="utf-8", newline="")
+        self._files.append(f)
+        self.paths.append(path)
+        return f
+
+    def _emit_ndjson(self, table, row):
+        self._ndjson.write(json.dumps(dict(table=table, **row), ensure_ascii=False))
+        self._ndjson.write("\n")
+
+    def add_chapter(self, title, lines):
+        paragraphs = [p for p in (_normalize_paragraph(l) for l in lines) if p]
+        if not paragraphs:
+            return
+        self.chapter_count += 1
+        chapter_id = str(uuid.uuid4())
+        title = _normalize_paragraph(title) or f"Chapter {self.chapter_count}"
+        if self.fmt == "ndjson":
+            self._emit_ndjson("chapters", {"id": chapter_id, "book_id": self.book_id, "title": title,
+                                           "order_index": self.chapter_count})
+            for j, content in enumerate(paragraphs, 1):
+                self._emit_ndjson("paragraphs", {"chapter_id": chapter_id, "content": content, "order_index": j})
+        else:
+            self._chapters.writerow([chapter_id, self.book_id, title, self.chapter_count])
+            self._paragraphs.writerows([chapter_id, content, j] for j, content in enumerate(paragraphs, 1))
+        self.paragraph_count += len(paragraphs)
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        self._files = []
+
+# functions/api/tts.ts 会把超过 1024 字节 (UTF-8) 的文本直接截断
+_TTS_MAX_BYTES = 1024
+_TTS_CLOSERS = "\"'”’)\\]）」』"
+_SENTENCE_BREAK_RE = re.compile(rf"(?:[。！？!?…]+|\.(?=\s|$|[{_TTS_CLOSERS}]))[{_TTS_CLOSERS}]*\s*")
+_CLAUSE_BREAK_RE = re.compile(rf"[,;:，；：、—]+[{_TTS_CLOSERS}]*\s*")
+_WORD_BREAK_RE = re.compile(r"\s+")
+_CJK_RE = re.compile(r"[\u4e00-\u9fff]")
+_STRONG_END_RE = re.compile(r"[.!?。！？]")
+_MEDIUM_END_RE = re.compile(r"[,;:，；：]")
+
+def _split_after(text, regex):
+    pieces = []
+    start = 0
+    for m in regex.finditer(text):
+        if m.end() > start:
+            pieces.append(text[start:m.end()])
+            start = m.end()
+    if start < len(text):
+        pieces.append(text[start:])
+    return pieces
+
+def _hard_split(text, max_bytes):
+    # 没有任何可用边界（例如超长的无标点中文）时按字符切，保证不切坏 UTF-8
+    pieces = []
+    cur = []
+    size = 0
+    for ch in text:
+        n = len(ch.encode("utf-8"))
+        if size + n > max_bytes and cur:
+            pieces.append("".join(cur))
+            cur, size = [], 0
+        cur.append(ch)
+        size += n
+    if cur:
+        pieces.append("".join(cur))
+    return pieces
+
+def _speech_chunks(paragraph, max_bytes=_TTS_MAX_BYTES, level=0):
+    """
+    把一个段落切成不超过 max_bytes 的朗读片段：先按句子，超长的句子再按分句、空白，最后按字符切；
+    同一层级的相邻片段在不超限时合并，减少 TTS 请求数。
+    """
+    splitters = (_SENTENCE_BREAK_RE, _CLAUSE_BREAK_RE, _WORD_BREAK_RE)
+    if level < len(splitters):
+        pieces = _split_after(paragraph, splitters[level])
+    else:
+        pieces = _hard_split(paragraph, max_bytes)
+    chunks = []
+    cur = ""
+    for piece in pieces:
+        if len(piece.strip().encode("utf-8")) > max_bytes:
+            if cur.strip():
+                chunks.append(cur.strip())
+            cur = ""
+            chunks.extend(_speech_chunks(piece, max_bytes, level + 1))
+        elif len((cur + piece).strip().encode("utf-8")) > max_bytes:
+            if cur.strip():
+                chunks.append(cur.strip())
+            cur = piece
+        else:
+            cur += piece
+    if cur.strip():
+        chunks.append(cur.strip())
+    return chunks
+
+def _pause_weight(text, is_last):
+    # 与 src/utils/rhythm.ts 的 sentenceEndPauseMs 系数一致，前端乘以 baseMs 即得停顿时长
+    end_char = text.strip()[-1:]
+    strong = bool(_STRONG_END_RE.match(end_char))
+    medium = bool(_MEDIUM_END_RE.match(end_char))
+    if is_last:
+        return 2.4 if strong else 2.0 if medium else 1.8
+    return 2.2 if strong else 1.6 if medium else 1.4
+
+def _write_tts_sidecar(output, md_file_path, chapter_index, title_text, lines, max_bytes=_TTS_MAX_BYTES):
+    """
+    为一章写出 TTS 朗读片段 sidecar（与章节文件同名，扩展名 .tts.json）。
+    段落编号与 _RecordsWriter 一致（规范化后非空的行，从 1 开始）；每个片段附带字节数、词数
+    （按空白切分，与 rhythm.ts 的 splitIntoTokens 一致）、汉字数与片段结尾的停顿系数。
+    """
+    chunks = []
+    paragraphs = [p for p in (_normalize_paragraph(l) for l in lines) if p]
+    for p_idx, paragraph in enumerate(paragraphs, 1):
+        pieces = _speech_chunks(paragraph, max_bytes)
+        for c_idx, text in enumerate(pieces):
+            is_last = c_idx == len(pieces) - 1
+            chunks.append({"paragraph": p_idx, "text": text, "bytes": len(text.encode("utf-8")),
+                           "words": len(text.split()), "cjk_chars": len(_CJK_RE.findall(text)),
+                           "pause_weight": _pause_weight(text, is_last), "paragraph_end": is_last})
+    path = md_file_path[:-len(".md")] + ".tts.json"
+    output.write(os.path.basename(path), json.dumps({"chapter": chapter_index, "title": title_text,
+                                                     "max_bytes": max_bytes, "paragraphs": len(paragraphs),
+                                                     "chunks": chunks}, ensure_ascii=False))
+    return path
+
+# 朗读速度：英文按每分钟 150 词、中文按每分钟 240 字；句末停顿同 rhythm.ts 的 sentenceEndPauseMs（baseMs 的 2.2 倍）
+_READ_ALOUD_WPM = 150
+_READ_ALOUD_CJK_PER_MINUTE = 240
+_SENTENCE_PAUSE_FACTOR = 2.2
+_ANALYTICS_WORD_RE = re.compile(r"[a-z]+(?:['’][a-z]+)*|[\u4e00-\u9fff]")
+_ANALYTICS_SENTENCE_RE = re.compile(r"[.!?。！？…]+|\n")
+_VOWEL_GROUP_RE = re.compile(r"[aeiouy]+")
+# 与 _ANALYTICS_WORD_RE 的英文词边界一致、不含元音的词（如 "hmm"、"rhythm"）
+_VOWELLESS_WORD_RE = re.compile(r"(?<![a-z])(?<![a-z]['’])[b-df-hj-np-tv-xz]+(?:['’][b-df-hj-np-tv-xz]+)*(?![a-z])(?!['’][a-z])")
+_SENTENCE_LENGTH_BUCKETS = (5, 10, 15, 20, 30)
+
+def _load_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+def _percentile(sorted_values, q):
+    # 线性插值，与 numpy.percentile 的默认方法一致
+    if not sorted_values:
+        return None
+    pos = (len(sorted_values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+def _readability(en_words, en_sentences, syllables, cjk_chars, sentences):
+    result = {"flesch_reading_ease": None, "fk_grade": None, "avg_sentence_chars": None}
+    if en_words and en_words >= cjk_chars and en_sentences:
+        wps = en_words / en_sentences
+        spw = syllables / en_words
+        result["flesch_reading_ease"] = round(206.835 - 1.015 * wps - 84.6 * spw, 1)
+        result["fk_grade"] = round(0.39 * wps + 11.8 * spw - 15.59, 1)
+    elif cjk_chars and sentences:
+        result["avg_sentence_chars"] = round(cjk_chars / sentences, 1)
+    return result
+
+class _BookAnalytics:
+    """
+    逐章统计词汇与可读性。每章只分词一次（英文单词小写、汉字按单字），其余计数都是整章上的单次正则扫描：
+    音节数 = 元音组数 + 不含元音的英文词数（即每词至少一个音节），词汇量用 set 去重。
+    句长分布在安装了 NumPy 时用数组计算，否则退回纯 Python，两者结果相同。
+    """
+    def __init__(self):
+        self.np = _load_numpy()
+        self.chapters = []
+        self._vocabulary = set()
+        self._sentence_lengths = []
+        self._totals = {"en_words": 0, "cjk_chars": 0, "syllables": 0, "sentences": 0, "en_sentences": 0}
+
+    def add_chapter(self, index, title, lines):
+        text = "\n".join(lines).lower()
+        tokens = []
+        lengths = []
+        en_sentences = 0
+        for sentence in _ANALYTICS_SENTENCE_RE.split(text):
+            words = _ANALYTICS_WORD_RE.findall(sentence)
+            if words:
+                tokens.extend(words)
+                lengths.append(len(words))
+                if not "\u4e00" <= words[-1][0] <= "\u9fff":
+                    en_sentences += 1
+        # 正文中的汉字与 ASCII 元音只会出现在词里，可以直接在整章文本上计数
+        cjk_chars = len(_CJK_RE.findall(text))
+        syllables = len(_VOWEL_GROUP_RE.findall(text)) + len(_VOWELLESS_WORD_RE.findall(text))
+        vocabulary = set(tokens)
+        self._vocabulary |= vocabulary
+        self._sentence_lengths.extend(lengths)
+        chapter_totals = {"en_words": len(tokens) - cjk_chars, "cjk_chars": cjk_chars, "syllables": syllables,
+                          "sentences": len(lengths), "en_sentences": en_sentences}
+        for k, v in chapter_totals.items():
+            self._totals[k] += v
+        self.chapters.append(dict(index=index, title=title, words=len(tokens), unique_words=len(vocabulary),
+                                  **self._summarize(chapter_totals, lengths, len(tokens), len(vocabulary))))
+
+    def _sentence_length_stats(self, lengths):
+        buckets = len(_SENTENCE_LENGTH_BUCKETS) + 1
+        if not lengths:
+            return None, None, None, [0] * buckets
+        if self.np is not None:
+            arr = self.np.asarray(lengths)
+            median, p90 = (float(v) for v in self.np.percentile(arr, [50, 90]))
+            histogram = self.np.bincount(self.np.searchsorted(_SENTENCE_LENGTH_BUCKETS, arr, side="left"),
+                                         minlength=buckets).tolist()
+            return median, p90, int(arr.max()), histogram
+        ordered = sorted(lengths)
+        histogram = [0] * buckets
+        for n in ordered:
+            histogram[bisect.bisect_left(_SENTENCE_LENGTH_BUCKETS, n)] += 1
+        return _percentile(ordered, 50), _percentile(ordered, 90), ordered[-1], histogram
+
+    def _summarize(self, totals, lengths, words, unique_words):
+        median, p90, longest, histogram = self._sentence_length_stats(lengths)
+        base_seconds = 60 / _READ_ALOUD_WPM
+        seconds = (totals["en_words"] * base_seconds + totals["cjk_chars"] * 60 / _READ_ALOUD_CJK_PER_MINUTE
+                   + totals["sentences"] * (_SENTENCE_PAUSE_FACTOR - 1) * base_seconds)
+        return dict(
+            type_token_ratio=round(unique_words / words, 4) if words else None,
+            sentences=totals["sentences"],
+            sentence_length={"mean": round(words / len(lengths), 2) if lengths else None,
+                             "median": round(median, 2) if median is not None else None,
+                             "p90": round(p90, 2) if p90 is not None else None,
+                             "max": longest,
+                             "histogram": dict(zip(["1-5", "6-10", "11-15", "16-20", "21-30", "31+"], histogram))},
+            read_aloud_minutes=round(seconds / 60, 1),
+            **_readability(totals["en_words"], totals["en_sentences"], totals["syllables"], totals["cjk_chars"],
+                           totals["sentences"]))
+
+    def write(self, output_dir, base_name, book_title):
+        vocabulary = sorted(self._vocabulary)
+        words = sum(c["words"] for c in self.chapters)
+        book = dict(title=book_title, chapters=len(self.chapters), words=words, unique_words=len(vocabulary),
+                    **self._summarize(self._totals, self._sentence_lengths, words, len(vocabulary)))
+        path = os.path.join(output_dir, f"{base_name}_stats.json")
+        _write_json_atomic(path, {"book": book, "chapters": self.chapters, "vocabulary": vocabulary})
+        return path
+
+_LIBRARY_SUMMARY_NAME = "library_stats.json"
+
+def _iter_book_stats(base_output_folder):
+    # 依次给出 (相对输出目录的路径, 内容)：书籍目录中的 *_stats.json，以及 --bundle 打包文件中的同名成员
+    with os.scandir(base_output_folder) as it:
+        entries = sorted((e for e in it if not e.name.startswith(".")), key=lambda e: e.name)
+    for e in entries:
+        if e.is_dir():
+            for name in sorted(os.listdir(e.path)):
+                if name.endswith("_stats.json"):
+                    try:
+                        with open(os.path.join(e.path, name), "rb") as f:
+                            yield os.path.join(e.name, name), f.read()
+                    except OSError:
+                        continue
+        elif e.is_file() and e.name.endswith(tuple(f".{fmt}" for fmt in _BUNDLE_FORMATS)):
+            book_dir = e.name.rsplit(".", 1)[0]
+            member = f"{book_dir}/{book_dir}_stats.json"
+            data = _read_bundle_member(e.path, member)
+            if data is not None:
+                yield os.path.join(e.name, member), data
+
+def _read_finished_book_stats(base_output_folder, output_dir):
+    # 只读取刚完成的那本书的 *_stats.json（书籍目录或打包文件成员），返回 (相对路径, 内容)，找不到时返回 None
+    book_dir = os.path.basename(output_dir)
+    name = f"{book_dir}_stats.json"
+    try:
+        with open(os.path.join(base_output_folder, book_dir, name), "rb") as f:
+            return os.path.join(book_dir, name), f.read()
+    except OSError:
+        pass
+    for fmt in _BUNDLE_FORMATS:
+        bundle_path = _bundle_path(os.path.join(base_output_folder, book_dir), fmt)
+        member = f"{book_dir}/{name}"
+        if os.path.isfile(bundle_path):
+            data = _read_bundle_member(bundle_path, member)
+            if data is not None:
+                return os.path.join(os.path.basename(bundle_path), member), data
+    return None
+
+def _library_book_entry(stats_file, raw):
+    # 从一本书的 *_stats.json 取出汇总所需字段，返回 (书目条目, 词汇表)；内容无法解析时返回 None
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        return None
+    book = data.get("book") or {}
+    entry = {k: book.get(k) for k in ("title", "chapters", "words", "unique_words", "type_token_ratio",
+                                      "flesch_reading_ease", "fk_grade", "avg_sentence_chars", "read_aloud_minutes")}
+    entry["stats_file"] = stats_file
+    return entry, data.get("vocabulary") or []
+
+def _write_library_summary_from(base_output_folder, books, library_vocabulary):
+    books = sorted(books, key=lambda b: (b["fk_grade"] is None, b["fk_grade"] or 0, b["title"] or ""))
+    summary = {"books": len(books), "words": sum(b["words"] or 0 for b in books),
+               "unique_words": library_vocabulary,
+               "read_aloud_hours": round(sum(b["read_aloud_minutes"] or 0 for b in books) / 60, 1),
+               "by_grade": books}
+    path = os.path.join(base_output_folder, _LIBRARY_SUMMARY_NAME)
+    _write_json_atomic(path, summary)
+    return path
+
+def _write_library_summary(base_output_folder):
+    """汇总输出目录下各书（含打包文件）的 *_stats.json，按年级分排序，并计算全库去重后的词汇量。"""
+    books = []
+    vocabularies = []
+    for stats_file, raw in _iter_book_stats(base_output_folder):
+        parsed = _library_book_entry(stats_file, raw)
+        if parsed is not None:
+            books.append(parsed[0])
+            vocabularies.append(parsed[1])
+    return _write_library_summary_from(base_output_folder, books, len(set().union(*vocabularies)))
+
+_LIBRARY_SUMMARY_INTERVAL = 10.0
+
+class _LibrarySummaryWriter:
+    """
+    常驻模式（监视 / 服务）下每完成一本书就刷新全库统计。首次使用时扫描一遍已有的 *_stats.json，
+    之后只读取刚完成的那本书，在内存中替换它的条目并按词出现的书数维护全库词汇表。
+    两次写出至少间隔 min_interval 秒，期间完成的书合并到计时器到期时的一次写出；close() 补写未写出的部分。
+    """
+    def __init__(self, base_output_folder, min_interval=_LIBRARY_SUMMARY_INTERVAL):
+        self.base_output_folder = base_output_folder
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.last_write = None
+        self.timer = None
+        self.dirty = False
+        self.books = None  # 相对路径 -> (书目条目, 词汇表)，首次使用时才扫描
+        self.vocabulary = None  # 词 -> 出现该词的书数
+
+    def _load(self):
+        from collections import Counter
+        self.books = {}
+        self.vocabulary = Counter()
+        for stats_file, raw in _iter_book_stats(self.base_output_folder):
+            self._put(stats_file, raw)
+
+    def _put(self, stats_file, raw):
+        parsed = _library_book_entry(stats_file, raw)
+        old = self.books.pop(stats_file, None)
+        if old is not None:
+            for word in old[1]:
+                self.vocabulary[word] -= 1
+                if not self.vocabulary[word]:
+                    del self.vocabulary[word]
+        if parsed is not None:
+            self.books[stats_file] = parsed
+            self.vocabulary.update(parsed[1])
+
+    def book_finished(self, output_dir):
+        with self.lock:
+            try:
+                if self.books is None:
+                    self._load()
+                else:
+                    found = _read_finished_book_stats(self.base_output_folder, output_dir)
+                    if found is not None:
+                        self._put(*found)
+            except OSError as e:
+                print(f"警告: 读取全库统计失败: {e}")
+                return
+            self.dirty = True
+            if self.timer is not None:
+                return
+            wait = 0.0 if self.last_write is None else self.last_write + self.min_interval - time.monotonic()
+            if wait > 0:
+                self.timer = threading.Timer(wait, self._flush_from_timer)
+                self.timer.daemon = True
+                self.timer.start()
+                return
+        self.flush()
+
+    def _flush_from_timer(self):
+        with self.lock:
+            self.timer = None
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            self.last_write = time.monotonic()
+            try:
+                _write_library_summary_from(self.base_output_folder, [entry for entry, _ in self.books.values()],
+                                            len(self.vocabulary))
+            except OSError as e:
+                print(f"警告: 写出全库统计失败: {e}")
+
+    def close(self):
+        with self.lock:
+            timer, self.timer = self.timer, None
+        if timer is not None:
+            timer.cancel()
+        self.flush()
+
+_LIBRARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    slug TEXT NOT NULL UNIQUE,
+    title TEXT NOT NULL,
+    authors TEXT,
+    publisher TEXT,
+    epub_sha256 TEXT,
+    source_path TEXT,
+    chapter_count INTEGER NOT NULL DEFAULT 0,
+    line_count INTEGER NOT NULL DEFAULT 0,
+    converted_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chapters (
+    id INTEGER PRIMARY KEY,
+    book_id INTEGER NOT NULL REFERENCES books(id) ON DELETE CASCADE,
+    order_index INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    file_name TEXT,
+    line_count INTEGER NOT NULL,
+    UNIQUE (book_id, order_index)
+);
+CREATE TABLE IF NOT EXISTS lines (
+    id INTEGER PRIMARY KEY,
+    book_id INTEGER NOT NULL REFERENCES books(id) ON DELETE CASCADE,
+    chapter_id INTEGER NOT NULL REFERENCES chapters(id) ON DELETE CASCADE,
+    line_no INTEGER NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lines_chapter ON lines(chapter_id, line_no);
+CREATE INDEX IF NOT EXISTS lines_book ON lines(book_id);
+"""
+
+class _LibraryDB:
+    """
+    全库 SQLite 输出：books / chapters / lines 三张表，外加以 lines 为外部内容的 FTS5 索引 lines_fts。
+    书以 slug（与输出文件夹同名）为唯一键，重复转换同一本书时整本替换，不会产生重复行。
+    转换过程中各章先写入连接私有的 TEMP 表（不占主库写锁、内存有界），
+    结束时在一个 BEGIN IMMEDIATE 事务内删除旧数据并批量 INSERT ... SELECT，
+    并行批量转换时各进程只在这一小段时间内串行。
+    """
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        # 新建的库切换 WAL 时需要独占锁且不走 busy 超时，多个进程同时打开时短暂重试
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                break
+            except sqlite3.OperationalError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(_LIBRARY_SCHEMA)
+        self.fts = self._ensure_fts()
+        self._staging = False
+
+    def _ensure_fts(self):
+        import sqlite3
+        if self._has_fts_table():
+            return True
+        # trigram 分词可做中英文子串检索（SQLite 3.34+），不支持时退回 unicode61；
+        # 多个进程可能同时打开新书库，建表放在写事务里并用 IF NOT EXISTS，失败后先确认是否已被别的进程建好
+        for tokenize in ("trigram", "unicode61"):
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS lines_fts USING fts5("
+                                  f"text, content='lines', content_rowid='id', tokenize='{tokenize}')")
+                self.conn.execute("COMMIT")
+                return True
+            except sqlite3.OperationalError:
+                if self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
+                if self._has_fts_table():
+                    return True
+        print("警告: 当前 SQLite 未编译 FTS5，书库将不建立全文索引。")
+        return False
+
+    def _has_fts_table(self):
+        return self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'lines_fts'").fetchone() is not None
+
+    def close(self):
+        self.conn.close()
+
+    def has_book(self, slug, epub_sha256):
+        row = self.conn.execute("SELECT epub_sha256 FROM books WHERE slug = ?", (slug,)).fetchone()
+        return bool(row) and epub_sha256 is not None and row[0] == epub_sha256
+
+    def begin_book(self):
+        self.conn.executescript("""
+            DROP TABLE IF EXISTS temp.staged_chapters;
+            DROP TABLE IF EXISTS temp.staged_lines;
+            CREATE TEMP TABLE staged_chapters (order_index INTEGER, title TEXT, file_name TEXT, line_count INTEGER);
+            CREATE TEMP TABLE staged_lines (order_index INTEGER, line_no INTEGER, text TEXT);
+        """)
+        self._staging = True
+
+    def add_chapter(self, order_index, title, file_name, lines):
+        self.conn.execute("INSERT INTO temp.staged_chapters VALUES (?, ?, ?, ?)",
+                          (order_index, title, file_name, len(lines)))
+        self.conn.executemany("INSERT INTO temp.staged_lines VALUES (?, ?, ?)",
+                              ((order_index, i, text) for i, text in enumerate(lines, 1)))
+
+    def commit_book(self, slug, title, authors, publisher, epub_sha256, source_path):
+        c = self.conn
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            old = c.execute("SELECT id FROM books WHERE slug = ?", (slug,)).fetchone()
+            if old:
+                if self.fts:
+                    c.execute("INSERT INTO lines_fts(lines_fts, rowid, text) "
+                              "SELECT 'delete', id, text FROM lines WHERE book_id = ?", old)
+                c.execute("DELETE FROM books WHERE id = ?", old)
+            chapter_count, line_count = c.execute(
+                "SELECT COUNT(*), COALESCE(SUM(line_count), 0) FROM temp.staged_chapters").fetchone()
+            book_id = c.execute(
+                "INSERT INTO books (slug, title, authors, publisher, epub_sha256, source_path, chapter_count, "
+                "line_count, converted_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (slug, title, authors, publisher, epub_sha256, source_path, chapter_count, line_count,
+                 time.time())).lastrowid
+            c.execute("INSERT INTO chapters (book_id, order_index, title, file_name, line_count) "
+                      "SELECT ?, order_index, title, file_name, line_count FROM temp.staged_chapters "
+                      "ORDER BY order_index", (book_id,))
+            c.execute("INSERT INTO lines (book_id, chapter_id, line_no, text) "
+                      "SELECT ?, ch.id, s.line_no, s.text FROM temp.staged_lines s "
+                      "JOIN chapters ch ON ch.book_id = ? AND ch.order_index = s.order_index "
+                      "ORDER BY s.order_index, s.line_no", (book_id, book_id))
+            if self.fts:
+                c.execute("INSERT INTO lines_fts(rowid, text) SELECT id, text FROM lines WHERE book_id = ?",
+                          (book_id,))
+            c.execute("COMMIT")
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        finally:
+            self.discard_book()
+        return book_id
+
+    def discard_book(self):
+        if self._staging:
+            self.conn.executescript("DROP TABLE IF EXISTS temp.staged_chapters; DROP TABLE IF EXISTS temp.staged_lines;")
+            self._staging = False
+
+    def search(self, query, limit=20):
+        """返回 (书名, 章节序号, 章节标题, 行号, 文本) 列表；没有 FTS5 时退回 LIKE 扫描。"""
+        select = ("SELECT b.title, ch.order_index, ch.title, l.line_no, l.text FROM {src} "
+                  "JOIN chapters ch ON ch.id = l.chapter_id JOIN books b ON b.id = l.book_id ")
+        # trigram 分词无法匹配少于 3 个字符的查询
+        if self.fts and len(query) >= 3:
+            sql = select.format(src="lines_fts f JOIN lines l ON l.id = f.rowid") + \
+                "WHERE lines_fts MATCH ? ORDER BY f.rank LIMIT ?"
+            # 按短语检索，避免用户输入被当作 FTS 查询语法
+            return self.conn.execute(sql, ('"' + query.replace('"', '""') + '"', limit)).fetchall()
+        sql = select.format(src="lines l") + "WHERE l.text LIKE ? ORDER BY l.id LIMIT ?"
+        return self.conn.execute(sql, (f"%{query}%", limit)).fetchall()
+
+def _write_chapter_file(output, idx, title_text, lines, fallback_number, stats=None):
+    safe_chapter_title = "".join(c if c.isalnum() or c in (' ', '_', '-') else '_' for c in title_text).rstrip()
+    if len(safe_chapter_title) > 80:
+        safe_chapter_title = safe_chapter_title[:80].rstrip()
+    if not safe_chapter_title:
+        safe_chapter_title = f"chapter_{fallback_number}"
+    file_line_count = 1 + len(lines)
+    md_file_name = f"{idx:03d}-{safe_chapter_title}_[{file_line_count}].md"
+    content = f"# {title_text} [{file_line_count}]\n\n" + "\n".join(lines)
+    output.write(md_file_name, content)
+    if stats is not None and stats.enabled:
+        stats.add_bytes(written=len(content.encode("utf-8")))
+    return output.path(md_file_name), file_line_count
+
+_BUNDLE_FORMATS = ("zip", "tar")
+_CHAPTER_FILE_RE = re.compile(r"\d{3,}-.*_\[\d+\]\.md")
+_STAGING_MARKER = ".epub2md-staging-"
+# 后台写出的批次：攒够这么多文件或字符就交给写线程；队列最多积压这么多批，超出时主线程等待
+_OUTPUT_BATCH_FILES = 64
+_OUTPUT_BATCH_CHARS = 1024 * 1024
+_OUTPUT_QUEUE_BATCHES = 4
+
+def _bundle_path(final_output_dir, bundle):
+    return f"{final_output_dir}.{bundle}"
+
+def _read_bundle_members(bundle_path, members):
+    # 打开一次打包文件，按顺序读出各成员；缺失的成员为 None，打包文件无法读取时返回 None
+    results = []
+    try:
+        if bundle_path.endswith(".zip"):
+            with zipfile.ZipFile(bundle_path) as z:
+                for member in members:
+                    try:
+                        results.append(z.read(member))
+                    except KeyError:
+                        results.append(None)
+        else:
+            with tarfile.open(bundle_path) as t:
+                for member in members:
+                    try:
+                        f = t.extractfile(member)
+                    except KeyError:
+                        f = None
+                    results.append(f.read() if f else None)
+    except (OSError, zipfile.BadZipFile, tarfile.TarError):
+        return None
+    return results
+
+def _read_bundle_member(bundle_path, member):
+    results = _read_bundle_members(bundle_path, [member])
+    return results[0] if results else None
+
+def _replay_cached_chapters(final_output_dir, bundle, file_names, on_chapter):
+    """
+    未变化的书跳过转换时，从已发布的章节文件还原每章的标题与正文行，按顺序回调 on_chapter，
+    流式调用方得到的 chapter 事件与重新转换时相同。章节文件缺失或无法读取时返回 False。
+    """
+    names = [n for n in file_names if _CHAPTER_FILE_RE.fullmatch(n)]
+    if bundle:
+        book_dir = os.path.basename(final_output_dir)
+        contents = _read_bundle_members(_bundle_path(final_output_dir, bundle), [f"{book_dir}/{n}" for n in names])
+        if contents is None or any(c is None for c in contents):
+            return False
+    else:
+        contents = []
+        try:
+            for n in names:
+                with open(os.path.join(final_output_dir, n), "rb") as f:
+                    contents.append(f.read())
+        except OSError:
+            return False
+    for index, (name, data) in enumerate(zip(names, contents), 1):
+        # 章节文件为 "# 标题 [行数]"、空行、正文各行
+        heading, _, body = data.decode("utf-8").partition("\n\n")
+        on_chapter({"index": index, "title": heading[2:].rsplit(" [", 1)[0],
+                    "file": os.path.join(final_output_dir, name), "lines": body.split("\n") if body else []})
+    return True
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+def _sweep_stale_staging(base_output_folder, safe_book_title):
+    # 清理被强制结束的进程遗留的暂存目录（进程仍在运行的不动）
+    prefix = f".{safe_book_title}{_STAGING_MARKER}"
+    try:
+        names = os.listdir(base_output_folder)
+    except OSError:
+        return
+    for name in names:
+        pid = name[len(prefix):].split("-", 1)[0] if name.startswith(prefix) else ""
+        if pid.isdigit() and not _pid_alive(int(pid)):
+            shutil.rmtree(os.path.join(base_output_folder, name), ignore_errors=True)
+
+def _rename_exchange(a, b):
+    # Linux 的 renameat2(RENAME_EXCHANGE) 原子交换两个路径；不支持时返回 False
+    if not sys.platform.startswith("linux"):
+        return False
+    import ctypes
+    import ctypes.util
+    try:
+        renameat2 = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True).renameat2
+    except (OSError, AttributeError):
+        return False
+    at_fdcwd, rename_exchange = -100, 2
+    return renameat2(at_fdcwd, os.fsencode(a), at_fdcwd, os.fsencode(b), rename_exchange) == 0
+
+def _replace_directory(src, dst):
+    """
+    用 src 目录替换 dst：dst 不存在时一次 rename 即可；否则在 Linux 上原子交换后删除旧目录，
+    其他平台退回两次 rename（其间 dst 会短暂不存在，但任何时刻都不会是写了一半的内容）。
+    """
+    try:
+        os.rename(src, dst)
+        return
+    except OSError:
+        if not os.path.isdir(dst):
+            raise
+    if _rename_exchange(src, dst):
+        shutil.rmtree(src, ignore_errors=True)
+        return
+    old = src + ".old"
+    os.rename(dst, old)
+    os.rename(src, dst)
+    shutil.rmtree(old, ignore_errors=True)
+
+class _BookOutput:
+    """
+    一本书的输出。所有文件先写入暂存目录：章节文件与 _full.md 的内容在内存中攒成批次，
+    由后台线程落盘，主线程只在积压超过上限时等待；全部成功后 publish() 一次性发布——
+    目录模式把暂存目录原子地改名为书籍目录，bundle 模式把整本书打包成单个 .zip / .tar
+    （暂存在本地临时目录，只往输出目录写一个文件），适合小文件很慢的网络文件系统。
+    发布前出错或中断则 discard() 丢弃暂存内容，已发布的旧版本保持不变。
+    path() 返回文件发布后的路径（bundle 模式下为解包到输出目录后的路径）。
+    """
+    def __init__(self, final_output_dir, bundle=None):
+        if bundle and bundle not in _BUNDLE_FORMATS:
+            raise ValueError(f"未知的打包格式: {bundle}")
+        self.final_dir = final_output_dir
+        self.bundle = bundle
+        self.bundle_path = _bundle_path(final_output_dir, bundle) if bundle else None
+        self.published = False
+        base_output_folder, safe_book_title = os.path.split(final_output_dir)
+        os.makedirs(base_output_folder or ".", exist_ok=True)
+        if bundle:
+            self.staging_dir = tempfile.mkdtemp(prefix="epub2md-stage-")
+        else:
+            # 暂存目录与书籍目录在同一文件系统上，发布时 rename 才是原子的
+            _sweep_stale_staging(base_output_folder or ".", safe_book_title)
+            self.staging_dir = os.path.join(base_output_folder,
+                                            f".{safe_book_title}{_STAGING_MARKER}{os.getpid()}-{threading.get_ident()}")
+            os.makedirs(self.staging_dir)
+        self._batch = []
+        self._batch_chars = 0
+        self._streams = {}
+        self._error = None
+        self._queue = queue.Queue(maxsize=_OUTPUT_QUEUE_BATCHES)
+        self._thread = threading.Thread(target=self._drain, name="epub2md-writer", daemon=True)
+        self._thread.start()
+
+    def path(self, name):
+        return os.path.join(self.final_dir, name)
+
+    def staged(self, name):
+        return os.path.join(self.staging_dir, name)
+
+    def write(self, name, text):
+        """整个文件的内容，后台写出。"""
+        self._add("write", name, text)
+
+    def append(self, name, text):
+        """追加到流式写出的文件（如 _full.md），文件在后台线程中保持打开。"""
+        self._add("append", name, text)
+
+    def _add(self, kind, name, text):
+        self._batch.append((kind, name, text))
+        self._batch_chars += len(text)
+        if len(self._batch) >= _OUTPUT_BATCH_FILES or self._batch_chars >= _OUTPUT_BATCH_CHARS:
+            self._submit()
+
+    def _submit(self):
+        if self._error is not None:
+            raise self._error
+        if self._batch:
+            self._queue.put(self._batch)
+            self._batch = []
+            self._batch_chars = 0
+
+    def _drain(self):
+        # 出错后继续取走批次（不再写入），保证主线程不会卡在 put 上；错误在下次提交或 close 时抛出
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            if self._error is None:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    self._error = e
+
+    def _write_batch(self, batch):
+        for kind, name, text in batch:
+            if kind == "append":
+                f = self._streams.get(name)
+                if f is None:
+                    f = self._streams[name] = open(self.staged(name), "w", encoding="utf-8")
+                f.write(text)
+            else:
+                with open(self.staged(name), "w", encoding="utf-8") as f:
+                    f.write(text)
+
+    def close(self):
+        """等待后台线程写完全部内容并关闭文件；写出失败时在这里抛出。"""
+        if self._thread is None:
+            return
+        try:
+            self._submit()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            for f in self._streams.values():
+                with contextlib.suppress(OSError):
+                    f.close()
+            self._streams = {}
+        if self._error is not None:
+            raise self._error
+
+    def publish(self):
+        self.close()
+        if self.bundle:
+            self._write_bundle()
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+        else:
+            _replace_directory(self.staging_dir, self.final_dir)
+        self.published = True
+
+    def _write_bundle(self):
+        # 成员放在 <书名>/ 下，解包后与目录模式的结构相同；先写临时文件再原子改名
+        book_dir = os.path.basename(self.final_dir)
+        names = sorted(os.listdir(self.staging_dir))
+        tmp_path = f"{self.bundle_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            if self.bundle == "zip":
+                with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as z:
+                    for name in names:
+                        z.write(self.staged(name), f"{book_dir}/{name}")
+            else:
+                with tarfile.open(tmp_path, "w") as t:
+                    for name in names:
+                        t.add(self.staged(name), f"{book_dir}/{name}", recursive=False)
+            os.replace(tmp_path, self.bundle_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+    def discard(self):
+        with contextlib.suppress(Exception):
+            self.close()
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+_ROMAN_OR_NUMBER_RE = re.compile(r"\d{1,3}|[IVXLCDM]+")
+
+def _title_from_line_range(lines, rng):
+    """
+    按 '7' 或 '1-2' 形式的行范围（从 1 开始）取章节正文中的行作为标题。
+    与 cand 合并规则一致：取到的标题只是编号（数字或罗马数字）时接上范围之后的一行。
+    """
+    rng = rng.strip()
+    try:
+        if '-' in rng:
+            a, b = rng.split('-', 1)
+            a = int(a.strip())
+            b = int(b.strip())
+            if not (1 <= a <= len(lines) and 1 <= b <= len(lines) and a <= b):
+                return None
+            title = re.sub(r"\s+", " ", " ".join(lines[a-1:b])).strip()
+            end_line = b
+        elif rng.isdigit():
+            end_line = int(rng)
+            if not 1 <= end_line <= len(lines):
+                return None
+            title = lines[end_line-1].strip()
+        else:
+            return None
+    except ValueError:
+        return None
+    if title and _ROMAN_OR_NUMBER_RE.fullmatch(title) and end_line < len(lines):
+        title = f"{title} {lines[end_line].strip()}"
+    return title or None
+
+_TITLE_RULES_SUFFIX = ".titles.json"
+
+class _TitleRules:
+    """
+    非交互的章节标题规则，来自与 EPUB 同名的 sidecar 文件 (book.epub -> book.titles.json)：
+
+        {
+          "chapters": {"3": "序章", "004-part2": {"lines": "1-2"}},
+          "fallback_lines": "1",
+          "replace": [["^Chapter\\s+", "第"], ["\\s*\\(.*\\)$", ""]]
+        }
+
+    chapters 按章节序号或文件名（不含扩展名）指定标题，值为标题文本或 {"lines": 行范围}；
+    fallback_lines 在自动标题退回文件名（无标题元素与 <title>）时改用正文的这些行；
+    replace 为依次作用于最终标题的正则替换。规则在自动启发式之后、交互预览之前生效。
+    """
+    def __init__(self, rules, digest=None):
+        if not isinstance(rules, dict):
+            raise ValueError("标题规则文件的顶层必须是对象")
+        self.chapters = {str(k): v for k, v in (rules.get("chapters") or {}).items()}
+        self.fallback_lines = rules.get("fallback_lines")
+        self.replace = [(re.compile(p), r) for p, r in rules.get("replace") or []]
+        self.digest = digest
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        return cls(json.loads(data.decode("utf-8")), hashlib.sha256(data).hexdigest())
+
+    @classmethod
+    def find(cls, epub_file_path, rules_path=None):
+        # rules_path 可以是规则文件本身，也可以是存放 <书名>.titles.json 的目录；未指定时查找 EPUB 旁的 sidecar
+        stem = os.path.splitext(os.path.basename(epub_file_path))[0]
+        if rules_path and not os.path.isdir(rules_path):
+            return cls.load(rules_path)
+        base_dir = rules_path or os.path.dirname(os.path.abspath(epub_file_path))
+        path = os.path.join(base_dir, stem + _TITLE_RULES_SUFFIX)
+        return cls.load(path) if os.path.exists(path) else None
+
+    def apply(self, idx, item_path, auto_title, lines):
+        base_name = os.path.splitext(os.path.basename(item_path))[0]
+        rule = self.chapters.get(str(idx), self.chapters.get(base_name))
+        title = None
+        if isinstance(rule, str):
+            title = rule.strip() or None
+        elif isinstance(rule, dict) and rule.get("lines"):
+            title = _title_from_line_range(lines, str(rule["lines"]))
+        if title is None and self.fallback_lines and auto_title == base_name:
+            title = _title_from_line_range(lines, str(self.fallback_lines))
+        title = title or auto_title
+        for pattern, repl in self.replace:
+            title = pattern.sub(repl, title)
+        return title.strip() or auto_title
+
+def _prompt_title_overrides(chapters):
+    # 无目录时逐章预览自动标题，允许通过 input() 指定某几行作为标题
+    title_overrides = {}
+    while True:
+        print("预览章节文件名:")
+        for idx, _, auto_title, lines in chapters:
+            t = title_overrides.get(idx, auto_title)
+            t = _short_title(t)
+            print(f"- {idx:03d} {t} ({len(lines)}行)")
+        print("是否使用上述自动选择？(y/n，回车默认为 y)")
+        use_auto = True
+        try:
+            ans = input().strip().lower()
+            if ans == 'n':
+                use_auto = False
+        except Exception:
+            use_auto = True
+        if use_auto:
+            break
+        print("请输入要调整标题的章节序号，例如 1 或 001：")
+        override_idx = None
+        try:
+            s = input().strip()
+            if s:
+                override_idx = int(s)
+        except Exception:
+            override_idx = None
+        if override_idx is None:
+            continue
+        found = False
+        for idx, _, auto_title, lines in chapters:
+            if idx == override_idx:
+                found = True
+                print("该章节前20行预览：")
+                preview_lines = lines[:20]
+                for i, l in enumerate(preview_lines, 1):
+                    print(f"{i:02d} {l}")
+                print("请输入标题行范围，例如 '1-2' 或 '7'：")
+                print("也可以输入 'b' 返回重新选择章节序号")
+                try:
+                    rng = input().strip()
+                except Exception:
+                    rng = ""
+                if rng.lower() in ('b', 'back'):
+                    break
+                override_title_text = _title_from_line_range(lines, rng)
+                if override_title_text:
+                    title_overrides[idx] = override_title_text
+                break
+        if not found:
+            continue
+    return title_overrides
+
+def convert_epub_to_markdown(epub_file_path, base_output_folder, interactive=False, report=None, text_backend=None,
+                             cache=None, force=False, stats=None, records_format=None, book_id=None,
+                             on_chapter=None, library_db=None, limits=None, title_rules=None, tts_chunks=False,
+                             images_dir=None, analytics=False, bundle=None):
     """
     从EPUB文件中提取内容并保存为Markdown文件。
     每个章节一个MD文件，以及一个包含所有内容的完整MD文件。
@@ -162,87 +2261,104 @@ def convert_epub_to_markdown(epub_file_path, base_output_folder):
     参数:
         epub_file_path (str): EPUB文件的路径。
         base_output_folder (str): 保存Markdown文件的基础目录 (例如: '~/Desktop')。
+        interactive (bool): 无目录时是否通过 input() 交互预览并调整章节标题，默认关闭，转换不会等待标准输入。
+        report (dict): 可选，传入时写入本书的统计信息 (title, chapters, lines, error)。
+        text_backend (str): HTML 转文本后端，'bs4'、'lxml' 或 'auto'（默认，有 lxml 时优先）。
+        cache (_ConversionCache): 可选。启用后，同一内容的EPUB若已转换过则直接跳过；
+            修订版只重新提取内容有变化的 spine 成员。
+        force (bool): 忽略已有的转换结果与缓存，强制重新转换（结果仍会写入缓存）。
+        stats (_ConversionStats): 可选，记录各阶段耗时、读写字节与峰值内存。
+        records_format (str): 可选，'ndjson' 或 'csv'，额外写出与 chapters/paragraphs 表结构一致的预分段记录。
+        book_id (str): 可选，写入记录时使用的书籍 id，默认随机生成 UUID。
+        on_chapter (callable): 可选，每写完一章即以 dict(index, title, file, lines) 回调，用于流式返回结果；
+            file 为发布后的路径，整本书发布之前该文件尚不存在。
+        library_db (str): 可选，SQLite 书库路径，整本书在一个事务内写入 books/chapters/lines 及全文索引。
+        limits (_ArchiveLimits): 可选，受限模式：读取前按中央目录检查大小/数量/压缩比，超大 XHTML 分块解析。
+        title_rules (str): 可选，标题规则文件或存放 <书名>.titles.json 的目录；默认查找 EPUB 旁的 sidecar。
+        tts_chunks (bool): 是否为每章额外写出 .tts.json 朗读片段 sidecar。
+        images_dir (str): 可选，全库共享的图片目录；提取正文引用的图片（按内容去重、生成缩略图），
+            并为含图章节写出 .images.json 索引。
+        analytics (bool): 是否统计词汇量、句长分布、可读性与朗读时长，写出 <书名>_stats.json。
+        bundle (str): 可选，'zip' 或 'tar'，把整本书打包为 base_output_folder 下的单个 <书名>.zip / .tar，
+            而不是书籍目录。无论哪种方式，输出都先写入暂存区，整本成功后才原子地发布。
 
     返回:
         tuple: (包含生成的MD文件路径的列表, 书籍输出文件夹的路径) 或 ([], "") 如果失败。
+            bundle 模式下为 ([打包文件路径], 打包文件路径)。
     """
     markdown_files = []
-    complete_text_content = ""
     book_title = os.path.splitext(os.path.basename(epub_file_path))[0]
 
-    # 创建一个临时目录来解压EPUB
-    temp_extract_path = tempfile.mkdtemp()
-
+    stats = stats or _NULL_STATS
+    library = None
+    image_store = None
+    output = None
     try:
+        backend = _get_text_backend(text_backend)
+        epub_hash = None
+        if cache or library_db:
+            with stats.stage("cache"):
+                epub_hash = _file_sha256(epub_file_path)
+                stats.add_bytes(read=os.path.getsize(epub_file_path))
+        # 直接从压缩包中按需读取成员，不解压到临时目录
         with zipfile.ZipFile(epub_file_path, 'r') as epub_zip:
-            epub_zip.extractall(temp_extract_path)
-            meta_title = None
-            meta_authors = []
-            meta_publisher = None
-            opf_path = None
-            for root_dir, _, files in os.walk(temp_extract_path):
-                for file in files:
-                    if file.endswith('.opf'):
-                        opf_path = os.path.join(root_dir, file)
-                        try:
-                            tree = ET.parse(opf_path)
-                            r = tree.getroot()
-                            for el in r.iter():
-                                if el.tag.endswith('title') and el.text:
-                                    meta_title = el.text.strip()
-                                elif el.tag.endswith('creator') and el.text:
-                                    meta_authors.append(el.text.strip())
-                                elif el.tag.endswith('publisher') and el.text:
-                                    meta_publisher = el.text.strip()
-                        except Exception:
-                            pass
-                        break
-                if opf_path:
-                    break
-            if meta_title:
-                book_title = meta_title
+            with stats.stage("open"):
+                if limits:
+                    _check_archive_limits(epub_zip, limits)
+                    backend = _ChunkedTextBackend(backend, limits.chunk_chars)
+                archive = _EpubArchive(epub_zip, stats)
+                opf_path = archive.find_opf()
+            with stats.stage("opf"):
+                package = _parse_package(archive, opf_path) if opf_path else None
+            meta_authors = package.authors if package else []
+            meta_publisher = package.publisher if package else None
+            if package and package.title:
+                book_title = package.title
             safe_book_title = "".join(c if c.isalnum() or c in (' ', '_', '-') else '_' for c in book_title).rstrip()
             if not safe_book_title:
                 safe_book_title = os.path.splitext(os.path.basename(epub_file_path))[0]
             final_output_dir = os.path.join(base_output_folder, safe_book_title)
-            os.makedirs(final_output_dir, exist_ok=True)
+            previous_manifest = None
+            if cache:
+                with stats.stage("cache"):
+                    previous_manifest = _read_book_manifest(final_output_dir, bundle)
+            if library_db:
+                library = _LibraryDB(library_db)
+            rules = _TitleRules.find(epub_file_path, title_rules)
+            # 只记录显式指定的 book_id；未指定时每次随机生成，不应使已有结果失效
+            output_options = {"text_backend": backend.name, "records": records_format,
+                              "book_id": book_id if records_format else None,
+                              "title_rules": rules.digest if rules else None,
+                              "tts": bool(tts_chunks), "images": os.path.abspath(images_dir) if images_dir else None,
+                              "analytics": bool(analytics)}
+            if (previous_manifest and not force and previous_manifest.get("epub_sha256") == epub_hash
+                    and dict(_DEFAULT_OUTPUT_OPTIONS, **previous_manifest.get("options", {})) == output_options
+                    and (not library or library.has_book(safe_book_title, epub_hash))):
+                if bundle:
+                    # 清单是从打包文件中读出的，打包文件本身即是全部输出
+                    cached_files = [_bundle_path(final_output_dir, bundle)] if previous_manifest.get("files") else []
+                else:
+                    cached_files = [os.path.join(final_output_dir, n) for n in previous_manifest.get("files", [])]
+                if (cached_files and all(os.path.exists(p) for p in cached_files)
+                        and (not on_chapter or _replay_cached_chapters(final_output_dir, bundle,
+                                                                        previous_manifest["files"], on_chapter))):
+                    if report is not None:
+                        report["title"] = previous_manifest.get("title", book_title)
+                        report["chapters"] = previous_manifest.get("chapters", 0)
+                        report["lines"] = previous_manifest.get("lines", 0)
+                        report["cached"] = True
+                    return cached_files, cached_files[0] if bundle else final_output_dir
+            output = _BookOutput(final_output_dir, bundle)
 
             spine_files = []
-            if opf_path:
-                try:
-                    tree = ET.parse(opf_path)
-                    r = tree.getroot()
-                    id_to_href = {}
-                    for el in r.iter():
-                        if el.tag.endswith('item'):
-                            iid = el.attrib.get('id')
-                            href = el.attrib.get('href')
-                            if iid and href:
-                                id_to_href[iid] = href
-                    order_ids = []
-                    for el in r.iter():
-                        if el.tag.endswith('itemref'):
-                            idref = el.attrib.get('idref')
-                            if idref:
-                                order_ids.append(idref)
-                    opf_dir = os.path.dirname(opf_path)
-                    for iid in order_ids:
-                        href = id_to_href.get(iid)
-                        if href:
-                            p = os.path.join(opf_dir, href)
-                            if os.path.exists(p) and p.lower().endswith(('.xhtml', '.html')):
-                                spine_files.append(p)
-                except Exception:
-                    pass
+            if package:
+                for item in package.spine:
+                    p = item.path
+                    if archive.exists(p) and p.lower().endswith(('.xhtml', '.html')):
+                        spine_files.append(p)
             content_files = spine_files
             if not content_files:
-                tmp = []
-                for root, _, files in os.walk(temp_extract_path):
-                    for file in files:
-                        if file.endswith(('.xhtml', '.html')):
-                            tmp.append(os.path.join(root, file))
-                tmp.sort()
-                content_files = tmp
+                content_files = archive.html_members()
 
             header_block = []
             header_block.append('---')
@@ -253,188 +2369,998 @@ def convert_epub_to_markdown(epub_file_path, base_output_folder):
                 header_block.append(f"publisher: {meta_publisher}")
             header_block.append('---')
             header_block.append('')
-            complete_text_content += "\n".join(header_block)
 
-            chapter_data = []
             toc_entries = []
-            if opf_path:
-                try:
-                    toc_entries = _get_toc_entries_from_opf(opf_path)
-                except Exception:
-                    toc_entries = []
-            if toc_entries:
-                gid = 1
-                groups = {}
-                order_files = []
-                for p, frag, title in toc_entries:
-                    if os.path.exists(p) and p.lower().endswith(('.xhtml', '.html')):
-                        if p not in groups:
-                            groups[p] = []
-                            order_files.append(p)
-                        groups[p].append((gid, frag, title))
-                        gid += 1
-                for fp in order_files:
-                    segs = _segment_file_by_toc(fp, groups.get(fp, []))
-                    for gid2, title2, lines2 in segs:
-                        chapter_data.append((gid2, fp, title2, lines2))
-            else:
-                for idx, item_path in enumerate(content_files, 1):
-                    with open(item_path, 'r', encoding='utf-8') as f:
-                        soup = BeautifulSoup(f, 'html.parser')
-                        text_content = soup.get_text(separator='\n', strip=True)
-                    base_name = os.path.splitext(os.path.basename(item_path))[0]
-                    book_title_lower = book_title.strip().lower()
-                    headings = soup.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
-                    cand = []
-                    for h in headings:
-                        t = h.get_text(separator=' ', strip=True)
-                        if t:
-                            t = re.sub(r"\s+", " ", t).strip()
-                            cand.append(t)
-                    cand = [t for t in cand if t.lower() != book_title_lower and t.lower() not in ("contents", "table of contents")]
-                    auto_title = None
-                    if cand:
-                        t0 = cand[0]
-                        if re.fullmatch(r"\d{1,3}", t0) or re.fullmatch(r"[IVXLCDM]+", t0):
-                            if len(cand) >= 2 and len(cand[1]) > 2:
-                                auto_title = f"{t0} {cand[1]}"
-                            else:
-                                auto_title = t0
-                        else:
-                            auto_title = t0
-                    if not auto_title and soup.title and soup.title.string:
-                        t = re.sub(r"\s+", " ", soup.title.string).strip()
-                        if t and t.lower() != book_title_lower:
-                            auto_title = t
-                    if not auto_title:
-                        auto_title = base_name
-                    lines = [l.strip() for l in text_content.splitlines() if l.strip()]
-                    chapter_data.append((idx, item_path, auto_title, lines))
-
-            title_overrides = {}
-            if not toc_entries:
-                while True:
-                    print("预览章节文件名:")
-                    for idx, _, auto_title, lines in chapter_data:
-                        t = title_overrides.get(idx, auto_title)
-                        t = _short_title(t)
-                        print(f"- {idx:03d} {t} ({len(lines)}行)")
-                    print("是否使用上述自动选择？(y/n，回车默认为 y)")
-                    use_auto = True
-                    try:
-                        ans = input().strip().lower()
-                        if ans == 'n':
-                            use_auto = False
-                    except Exception:
-                        use_auto = True
-                    if use_auto:
-                        break
-                    print("请输入要调整标题的章节序号，例如 1 或 001：")
-                    override_idx = None
+            if package:
+                with stats.stage("toc"):
                     try:
-                        s = input().strip()
-                        if s:
-                            override_idx = int(s)
+                        toc_entries = _get_toc_entries_from_opf(archive, package)
                     except Exception:
-                        override_idx = None
-                    if override_idx is None:
-                        continue
-                    found = False
-                    for idx, _, auto_title, lines in chapter_data:
-                        if idx == override_idx:
-                            found = True
-                            print("该章节前20行预览：")
-                            preview_lines = lines[:20]
-                            for i, l in enumerate(preview_lines, 1):
-                                print(f"{i:02d} {l}")
-                            print("请输入标题行范围，例如 '1-2' 或 '7'：")
-                            print("也可以输入 'b' 返回重新选择章节序号")
-                            override_title_text = None
-                            try:
-                                rng = input().strip()
-                                if rng.lower() in ('b', 'back'):
-                                    override_title_text = None
-                                    break
-                                if '-' in rng:
-                                    a, b = rng.split('-', 1)
-                                    a = int(a.strip())
-                                    b = int(b.strip())
-                                    if 1 <= a <= len(lines) and 1 <= b <= len(lines) and a <= b:
-                                        sel = [lines[i-1] for i in range(a, b+1)]
-                                        override_title_text = re.sub(r"\s+", " ", " ".join(sel)).strip()
-                                elif rng.isdigit():
-                                    k = int(rng)
-                                    if 1 <= k <= len(lines):
-                                        override_title_text = lines[k-1].strip()
-                            except Exception:
-                                override_title_text = None
-                            if override_title_text:
-                                if re.fullmatch(r"\d{1,3}", override_title_text) or re.fullmatch(r"[IVXLCDM]+", override_title_text):
-                                    end_line = None
-                                    if '-' in rng:
-                                        try:
-                                            end_line = int(rng.split('-', 1)[1].strip())
-                                        except Exception:
-                                            end_line = None
-                                    else:
-                                        try:
-                                            end_line = int(rng)
-                                        except Exception:
-                                            end_line = None
-                                    if end_line and end_line < len(lines):
-                                        override_title_text = f"{override_title_text} {lines[end_line].strip()}"
-                                title_overrides[idx] = override_title_text
-                            break
-                    if not found:
-                        continue
+                        toc_entries = []
+            cache_info = {"members": {}, "reused": 0}
+            image_refs = {} if images_dir else None
+            chapters = _iter_chapters(archive, content_files, toc_entries, book_title, backend,
+                                      cache=cache, force=force, cache_info=cache_info, stats=stats,
+                                      image_refs=image_refs)
+            if rules:
+                chapters = ((idx, p, rules.apply(idx, p, t, lines), lines) for idx, p, t, lines in chapters)
+
+            title_overrides = {}
+            if not toc_entries and interactive:
+                # 交互预览需要看到全部章节，只有这种情况下才整本物化
+                chapters = list(chapters)
+                title_overrides = _prompt_title_overrides(chapters)
+
+            # 包含所有内容的完整Markdown文件与章节文件同步流式写出
+            # 使用 "_full" 后缀以避免与可能的章节文件名冲突
+            complete_md_file_name = f"{safe_book_title}_full.md"
+            complete_md_file_path = output.path(complete_md_file_name)
+            chapter_count = 0
+            total_lines = 0
+            sidecar_files = []
+            if images_dir:
+                image_store = _ImageStore(images_dir)
+            book_analytics = _BookAnalytics() if analytics else None
+            records = None
+            if records_format:
+                records = _RecordsWriter(output.staging_dir, safe_book_title, records_format, book_title,
+                                         ", ".join(meta_authors) or None, book_id)
+            if library:
+                library.begin_book()
+            with contextlib.ExitStack() as outputs:
+                if records:
+                    outputs.callback(records.close)
+                complete_md_bytes = 0
+                output.append(complete_md_file_name, "\n".join(header_block))
+                for idx, item_path, auto_title, lines in chapters:
+                    with stats.stage("write"):
+                        title_text = _short_title(title_overrides.get(idx, auto_title))
+                        md_file_path, file_line_count = _write_chapter_file(output, idx, title_text, lines,
+                                                                            len(markdown_files) + 1, stats)
+                        markdown_files.append(md_file_path)
+                        complete_md_chunk = f"# {title_text} [{file_line_count}]\n\n" + "\n".join(lines) + "\n\n---\n\n"
+                        output.append(complete_md_file_name, complete_md_chunk)
+                        if stats.enabled:
+                            complete_md_bytes += len(complete_md_chunk.encode("utf-8"))
+                        if records:
+                            records.add_chapter(title_text, lines)
+                        if tts_chunks:
+                            sidecar_files.append(_write_tts_sidecar(output, md_file_path, chapter_count + 1,
+                                                                    title_text, lines))
+                    if book_analytics:
+                        with stats.stage("analytics"):
+                            book_analytics.add_chapter(chapter_count + 1, title_text, lines)
+                    if image_store and image_refs.get(idx):
+                        with stats.stage("images"):
+                            images = []
+                            for after_line, member_path in image_refs.pop(idx):
+                                record = image_store.add(archive, member_path)
+                                if record:
+                                    images.append(dict(after_line=after_line, **record))
+                            if images:
+                                sidecar_files.append(_write_image_index(output, md_file_path, chapter_count + 1,
+                                                                        title_text, images, images_dir))
+                    if library:
+                        with stats.stage("library"):
+                            library.add_chapter(chapter_count + 1, title_text, os.path.basename(md_file_path), lines)
+                    chapter_count += 1
+                    if on_chapter:
+                        on_chapter({"index": chapter_count, "title": title_text, "file": md_file_path,
+                                    "lines": lines})
+                    total_lines += len(lines)
+                if stats.enabled:
+                    with stats.stage("write"):
+                        stats.add_bytes(written=len("\n".join(header_block).encode("utf-8")) + complete_md_bytes)
+            if image_store:
+                with stats.stage("images"):
+                    image_store.close()
+            if book_analytics:
+                with stats.stage("analytics"):
+                    stats_path = book_analytics.write(output.staging_dir, safe_book_title, book_title)
+                    sidecar_files.append(output.path(os.path.basename(stats_path)))
 
-            for idx, item_path, auto_title, lines in chapter_data:
-                title_text = _short_title(title_overrides.get(idx, auto_title))
-                safe_chapter_title = "".join(c if c.isalnum() or c in (' ', '_', '-') else '_' for c in title_text).rstrip()
-                if len(safe_chapter_title) > 80:
-                    safe_chapter_title = safe_chapter_title[:80].rstrip()
-                if not safe_chapter_title:
-                    safe_chapter_title = f"chapter_{len(markdown_files) + 1}"
-                file_line_count = 1 + len(lines)
-                md_file_name = f"{idx:03d}-{safe_chapter_title}_[{file_line_count}].md"
-                md_file_path = os.path.join(final_output_dir, md_file_name)
-                if not os.path.isdir(final_output_dir):
-                    os.makedirs(final_output_dir, exist_ok=True)
-                with open(md_file_path, 'w', encoding='utf-8') as md_file:
-                    md_file.write(f"# {title_text} [{file_line_count}]\n\n")
-                    md_file.write("\n".join(lines))
-                markdown_files.append(md_file_path)
-                complete_text_content += f"# {title_text} [{file_line_count}]\n\n{"\n".join(lines)}\n\n---\n\n"
-
-        # 保存包含所有内容的完整Markdown文件
-        # 使用 "_full" 后缀以避免与可能的章节文件名冲突
-        complete_md_file_name = f"{safe_book_title}_full.md"
-        complete_md_file_path = os.path.join(final_output_dir, complete_md_file_name)
-        if not os.path.isdir(final_output_dir):
-            os.makedirs(final_output_dir, exist_ok=True)
-        with open(complete_md_file_path, 'w', encoding='utf-8') as complete_md_file:
-            complete_md_file.write(complete_text_content)
-        
         markdown_files.append(complete_md_file_path)
-        
+        markdown_files.extend(sidecar_files)
+        if records:
+            markdown_files.extend(output.path(os.path.basename(p)) for p in records.paths)
+        if cache:
+            # 书籍目录整体替换，旧版本留下的文件不会残留；清单随整本书一起发布
+            output.write(_BOOK_MANIFEST_NAME, json.dumps({
+                "version": _CACHE_VERSION,
+                "epub_sha256": epub_hash,
+                "title": book_title,
+                "chapters": chapter_count,
+                "lines": total_lines,
+                "members": cache_info["members"],
+                "options": output_options,
+                "files": [os.path.basename(p) for p in markdown_files],
+            }, ensure_ascii=False))
+        with stats.stage("write"):
+            output.close()
+        with stats.stage("publish"):
+            output.publish()
+        # 先发布文件再提交书库：发布失败时书库不会指向不存在的输出；
+        # 提交失败时书库中没有这本书的当前哈希，下次转换不会走“未变化”捷径而是重新写入
+        if library:
+            with stats.stage("library"):
+                library.commit_book(safe_book_title, book_title, ", ".join(meta_authors) or None, meta_publisher,
+                                    epub_hash, os.path.abspath(epub_file_path))
+        if cache:
+            cache.maybe_evict()
+        if report is not None:
+            report["title"] = book_title
+            report["chapters"] = chapter_count
+            report["lines"] = total_lines
+            report["cached"] = False
+            report["members_reused"] = cache_info["reused"]
+            if image_store:
+                report["images"] = {"stored": image_store.stored, "reused": image_store.reused,
+                                    "failed": image_store.failed}
+            if records:
+                report["records"] = {"book_id": records.book_id, "chapters": records.chapter_count,
+                                     "paragraphs": records.paragraph_count}
+        if bundle:
+            return [output.bundle_path], output.bundle_path
         return markdown_files, final_output_dir
 
     except Exception as e:
+        if report is not None:
+            report["error"] = f"{type(e).__name__}: {e}"
         print(f"处理EPUB '{epub_file_path}' 时出错: {e}")
+        if isinstance(e, _ArchiveLimitError):
+            return [], ""
         # 打印更详细的错误信息，有助于调试
         import traceback
         traceback.print_exc()
         return [], ""
     finally:
-        # 清理临时目录
-        if os.path.exists(temp_extract_path):
-            shutil.rmtree(temp_extract_path)
+        if output and not output.published:
+            output.discard()
+        if library:
+            library.close()
+        if image_store:
+            image_store.close()
+
+def _convert_book_job(epub_path, base_output_folder, options=None, interactive=False,
+                      collect_stats=False, trace_memory=False, profile_dir=None):
+    """
+    单本转换任务（也在进程池中执行），异常不会向外抛出；options 为传给转换函数的关键字参数。
+    collect_stats 时在结果中附带各阶段统计；profile_dir 非空时用 cProfile 记录并把 .prof 文件写入该目录。
+    """
+    report = {"path": epub_path, "title": "", "chapters": 0, "lines": 0, "error": None}
+    stats = _ConversionStats(trace_memory=trace_memory) if collect_stats else None
+    profiler = None
+    if profile_dir:
+        import cProfile
+        profiler = cProfile.Profile()
+    t0 = time.perf_counter()
+    try:
+        if profiler:
+            profiler.enable()
+        try:
+            files, out_dir = convert_epub_to_markdown(epub_path, base_output_folder, interactive=interactive,
+                                                      report=report, stats=stats, **(options or {}))
+        finally:
+            if profiler:
+                profiler.disable()
+    except Exception as e:
+        files, out_dir = [], ""
+        report["error"] = f"{type(e).__name__}: {e}"
+    report["seconds"] = time.perf_counter() - t0
+    if stats:
+        report["stats"] = stats.to_dict()
+    if profiler:
+        fd, prof_path = tempfile.mkstemp(suffix=".prof", dir=profile_dir)
+        os.close(fd)
+        profiler.dump_stats(prof_path)
+        report["profile_path"] = prof_path
+    report["files"] = files
+    report["output_dir"] = out_dir
+    report["ok"] = bool(files)
+    if not files and not report["error"]:
+        report["error"] = "未生成任何文件"
+    return report
+
+def _print_batch_summary(reports, wall_seconds):
+    print("\n批量转换汇总:")
+    print(f"{'状态':<4} {'章节':>6} {'行数':>8} {'耗时(s)':>8}  书籍")
+    for r in reports:
+        name = r.get("title") or os.path.basename(r["path"])
+        status = "成功" if r.get("ok") else "失败"
+        print(f"{status:<4} {r.get('chapters', 0):>6} {r.get('lines', 0):>8} {r.get('seconds', 0.0):>8.2f}  {name}")
+    ok = [r for r in reports if r.get("ok")]
+    print(f"共 {len(reports)} 本，成功 {len(ok)} 本，失败 {len(reports) - len(ok)} 本；"
+          f"章节 {sum(r.get('chapters', 0) for r in ok)}，行数 {sum(r.get('lines', 0) for r in ok)}，"
+          f"总耗时 {wall_seconds:.2f}s")
+
+def _aggregate_stats(reports):
+    # 汇总一批书的阶段统计：各阶段耗时/字节求和，tracemalloc 峰值取最大；
+    # 峰值 RSS 按整次运行计（进程池在此之前已关闭，其工作进程计入 RUSAGE_CHILDREN）
+    stages = {}
+    for r in reports:
+        st = r.get("stats")
+        if not st:
+            continue
+        for name, rec in st["stages"].items():
+            agg = stages.setdefault(name, {"seconds": 0.0, "calls": 0, "bytes_read": 0, "bytes_written": 0})
+            for k, v in rec.items():
+                if k == "peak_traced_bytes":
+                    agg[k] = max(agg.get(k, 0), v)
+                else:
+                    agg[k] += v
+    for rec in stages.values():
+        rec["seconds"] = round(rec["seconds"], 6)
+    slowest = max(reports, key=lambda r: r.get("seconds", 0.0), default=None)
+    return {
+        "books": len(reports),
+        "succeeded": sum(1 for r in reports if r.get("ok")),
+        "book_seconds": round(sum(r.get("seconds", 0.0) for r in reports), 6),
+        "stages": stages,
+        "peak_rss_bytes": _peak_rss_bytes(include_children=True),
+        "slowest": {"path": slowest["path"], "seconds": round(slowest.get("seconds", 0.0), 6)} if slowest else None,
+    }
+
+def _write_stats_report(path, reports, wall_seconds):
+    books = []
+    for r in reports:
+        books.append({
+            "path": r["path"],
+            "title": r.get("title", ""),
+            "ok": bool(r.get("ok")),
+            "error": r.get("error"),
+            "cached": bool(r.get("cached")),
+            "chapters": r.get("chapters", 0),
+            "lines": r.get("lines", 0),
+            "seconds": round(r.get("seconds", 0.0), 6),
+            **(r.get("stats") or {}),
+        })
+    aggregate = _aggregate_stats(reports)
+    aggregate["wall_seconds"] = round(wall_seconds, 6)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"books": books, "aggregate": aggregate}, f, ensure_ascii=False, indent=2)
+
+def _keep_slowest_profile(reports, dest_path):
+    # 只保留最慢那本书的 cProfile 结果，其余删除
+    profiled = [r for r in reports if r.get("profile_path")]
+    if not profiled:
+        return None
+    slowest = max(profiled, key=lambda r: r.get("seconds", 0.0))
+    shutil.move(slowest["profile_path"], dest_path)
+    for r in profiled:
+        if r is not slowest and os.path.exists(r["profile_path"]):
+            os.remove(r["profile_path"])
+    return slowest
+
+def _run_batch(epub_paths, base_output_folder, jobs, options=None, collect_stats=False, trace_memory=False,
+               profile_dir=None):
+    """
+    将多本书分发到进程池并行转换，按完成顺序输出每本书的结果，最后打印汇总表。
+    单本失败（包括工作进程崩溃）不会中断整个批次。
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    reports = []
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(_convert_book_job, p, base_output_folder, options, False,
+                               collect_stats, trace_memory, profile_dir): p for p in epub_paths}
+        for done, fut in enumerate(as_completed(futures), 1):
+            path = futures[fut]
+            try:
+                r = fut.result()
+            except Exception as e:
+                r = {"path": path, "ok": False, "chapters": 0, "lines": 0, "seconds": 0.0,
+                     "error": f"{type(e).__name__}: {e}"}
+            reports.append(r)
+            if r.get("ok") and r.get("cached"):
+                print(f"[{done}/{len(epub_paths)}] 未变化，已跳过: {path} -> {r['output_dir']}")
+            elif r.get("ok"):
+                print(f"[{done}/{len(epub_paths)}] 成功: {path} -> {r['output_dir']} "
+                      f"({r['chapters']} 章, {r['lines']} 行, {r['seconds']:.2f}s)")
+            else:
+                print(f"[{done}/{len(epub_paths)}] 失败: {path} | {r.get('error')}")
+    _print_batch_summary(reports, time.perf_counter() - t0)
+    return reports
+
+_DEFAULT_SERVE_QUEUE = 16
+_DEFAULT_MAX_UPLOAD_BYTES = 200 * 1024 * 1024
+# JSON 请求体只含参数，在准入之前读取，因此单独设一个很小的上限
+_MAX_JSON_REQUEST_BYTES = 64 * 1024
+
+class _JobSlots:
+    """
+    常驻服务的有界任务池：最多 jobs 个转换同时运行，另有 max_queue 个等待位；
+    都占满时 try_enter 返回 False，由调用方直接拒绝（503），而不是无限堆积请求。
+    """
+    def __init__(self, jobs, max_queue):
+        self.jobs = jobs
+        self.max_queue = max_queue
+        self._running = threading.BoundedSemaphore(jobs)
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def try_enter(self):
+        with self._lock:
+            if self.admitted - self.completed >= self.jobs + self.max_queue:
+                self.rejected += 1
+                return False
+            self.admitted += 1
+            return True
+
+    @contextlib.contextmanager
+    def admission(self):
+        # try_enter 成功后的整个请求处理都在其中，无论成败（包括上传落盘失败）都归还名额
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.completed += 1
+
+    def running(self):
+        return self._running
+
+    def snapshot(self):
+        with self._lock:
+            in_flight = self.admitted - self.completed
+        return {"jobs": self.jobs, "max_queue": self.max_queue, "in_flight": in_flight,
+                "completed": self.completed, "rejected": self.rejected}
+
+def _stream_book_job(epub_path, base_output_folder, options, events, cancel, with_lines):
+    """
+    常驻服务在工作进程中执行的单本转换：每章一条 chapter 事件放入 events（Manager 队列），
+    由请求线程转发给客户端；cancel 被设置（客户端已断开）后在下一章中止。
+    """
+    def on_chapter(chapter):
+        if cancel.is_set():
+            raise ConnectionAbortedError("客户端已断开")
+        event = {"event": "chapter", "index": chapter["index"], "title": chapter["title"],
+                 "file": chapter["file"], "line_count": len(chapter["lines"])}
+        if with_lines:
+            event["lines"] = chapter["lines"]
+        events.put(event)
+
+    return _convert_book_job(epub_path, base_output_folder, dict(options, on_chapter=on_chapter))
+
+class _ServePool:
+    """
+    常驻服务的工作进程池：启动时拉起并预热全部进程，转换在进程中并行执行，不受 GIL 限制；
+    章节事件经 Manager 队列流回请求线程。工作进程崩溃导致进程池失效时重建。
+    使用 spawn 启动进程，避免在已有请求线程的进程中 fork。
+    """
+    def __init__(self, jobs, text_backend=None):
+        import multiprocessing
+        self.jobs = jobs
+        self.text_backend = text_backend
+        self._context = multiprocessing.get_context("spawn")
+        self._manager = self._context.Manager()
+        self._lock = threading.Lock()
+        self._executor = self._start()
+
+    def _start(self):
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=self.jobs, mp_context=self._context,
+                                       initializer=_warm_up, initargs=(self.text_backend,))
+        # 提前拉起全部工作进程，首个请求不必等待进程启动与预热
+        for f in [executor.submit(os.getpid) for _ in range(self.jobs)]:
+            f.result()
+        return executor
+
+    def _submit(self, *args):
+        from concurrent.futures.process import BrokenProcessPool
+        with self._lock:
+            try:
+                return self._executor.submit(*args)
+            except BrokenProcessPool:
+                self._executor.shutdown(wait=False)
+                self._executor = self._start()
+                return self._executor.submit(*args)
+
+    def convert(self, epub_path, base_output_folder, options, with_lines, emit):
+        """
+        在工作进程中转换一本书，chapter 事件依次交给 emit；emit 返回 False（客户端已断开）时通知进程中止。
+        返回 _convert_book_job 的结果；进程崩溃等异常也折算为失败的结果。
+        """
+        events = self._manager.Queue()
+        cancel = self._manager.Event()
+        try:
+            future = self._submit(_stream_book_job, epub_path, base_output_folder, options, events, cancel, with_lines)
+        except Exception as e:
+            future = None
+            error = e
+        if future is not None:
+            # 进程把全部事件放入队列之后任务才会完成，结束标记一定排在最后
+            future.add_done_callback(lambda f: events.put(None))
+            while True:
+                event = events.get()
+                if event is None:
+                    break
+                if not emit(event):
+                    cancel.set()
+            try:
+                return future.result()
+            except Exception as e:
+                error = e
+        return {"path": epub_path, "ok": False, "chapters": 0, "lines": 0, "seconds": 0.0, "files": [],
+                "output_dir": "", "error": f"{type(error).__name__}: {error}"}
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._manager.shutdown()
+
+def _make_worker_handler(base_output_folder, slots, pool, options, max_upload_bytes, summary=None):
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlsplit, parse_qs
+
+    class _WorkerHandler(BaseHTTPRequestHandler):
+        """
+        GET  /health   返回任务池状态；
+        POST /convert  请求体为 JSON {"path": ...} 或 EPUB 原始字节（文件名放在 ?name=），
+                       其余参数 force / records / book_id / lines 取自查询串或 JSON；
+                       响应为 NDJSON 流：start、每章一条 chapter、最后一条 done。
+        上传的 EPUB 在获得任务位之后才读取，并按块写入临时文件，被拒绝的请求不会占用内存。
+        """
+        protocol_version = "HTTP/1.1"
+
+        def address_string(self):
+            # Unix 套接字没有对端地址
+            return self.client_address[0] if self.client_address else "unix"
+
+        def log_message(self, format, *args):
+            sys.stderr.write(f"[{time.strftime('%H:%M:%S')}] {self.address_string()} {format % args}\n")
+
+        def _send_json(self, code, obj, headers=None):
+            body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlsplit(self.path).path != "/health":
+                self._send_json(404, {"error": "not found"})
+                return
+            self._send_json(200, dict(ok=True, **slots.snapshot()))
+
+        def _read_request(self):
+            """返回 (参数, 待读取的上传字节数)；JSON 请求体在这里读完，上传的 EPUB 留在连接中由准入后读取。"""
+            query = {k: v[-1] for k, v in parse_qs(urlsplit(self.path).query).items()}
+            length = int(self.headers.get("Content-Length") or 0)
+            if length <= 0:
+                raise ValueError("缺少请求体")
+            if length > max_upload_bytes:
+                raise ValueError(f"请求体超过上限 {max_upload_bytes} 字节")
+            content_type = (self.headers.get("Content-Type") or "").split(";")[0].strip()
+            if content_type == "application/json":
+                if length > _MAX_JSON_REQUEST_BYTES:
+                    raise ValueError(f"JSON 请求体超过上限 {_MAX_JSON_REQUEST_BYTES} 字节")
+                params = json.loads(self.rfile.read(length).decode("utf-8"))
+                if not isinstance(params, dict) or not params.get("path"):
+                    raise ValueError("JSON 请求体需要 path 字段")
+                query.update({k: v for k, v in params.items() if v is not None})
+                return query, 0
+            return query, length
+
+        def _receive_upload(self, path, length):
+            with open(path, "wb") as f:
+                while length > 0:
+                    block = self.rfile.read(min(length, _STREAM_BLOCK_BYTES))
+                    if not block:
+                        raise ConnectionError("上传未完成，连接已断开")
+                    f.write(block)
+                    length -= len(block)
+
+        def do_POST(self):
+            if urlsplit(self.path).path != "/convert":
+                self._send_json(404, {"error": "not found"})
+                return
+            # 以下拒绝时请求体可能尚未读取，连接不能复用
+            try:
+                params, upload_length = self._read_request()
+            except ValueError as e:
+                self.close_connection = True
+                self._send_json(400, {"error": str(e)})
+                return
+            if params.get("records") not in (None, "") + _RECORDS_FORMATS:
+                self.close_connection = True
+                self._send_json(400, {"error": f"未知的记录格式: {params['records']}"})
+                return
+            if not slots.try_enter():
+                self.close_connection = True
+                self._send_json(503, dict(error="任务队列已满", **slots.snapshot()), {"Retry-After": "5"})
+                return
+            self._disconnected = False
+            self.close_connection = True
+            with slots.admission():
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.send_header("Connection", "close")
+                    self.end_headers()
+                    with tempfile.TemporaryDirectory(prefix="epub2md-upload-") as tmp_dir:
+                        if upload_length:
+                            name = os.path.basename(params.get("name") or "upload.epub")
+                            if not name.lower().endswith(".epub"):
+                                name += ".epub"
+                            epub_path = os.path.join(tmp_dir, name)
+                            self._receive_upload(epub_path, upload_length)
+                        else:
+                            epub_path = params["path"]
+                        self._convert_streaming(epub_path, params)
+                except OSError as e:
+                    self._emit({"event": "done", "ok": False, "error": f"{type(e).__name__}: {e}"})
+            if not self._disconnected:
+                with contextlib.suppress(OSError):
+                    self.wfile.write(b"0\r\n\r\n")
+
+        def _emit(self, event):
+            if self._disconnected:
+                return
+            data = (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+            try:
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+            except OSError:
+                self._disconnected = True
+
+        def _convert_streaming(self, epub_path, params):
+            with_lines = str(params.get("lines", "")).lower() in ("1", "true", "yes")
+            job_options = dict(options)
+            job_options["force"] = job_options.get("force") or str(params.get("force", "")).lower() in ("1", "true", "yes")
+            job_options["records_format"] = params.get("records") or job_options.get("records_format")
+            job_options["book_id"] = params.get("book_id") or None
+
+            def emit(event):
+                self._emit(event)
+                return not self._disconnected
+
+            with slots.running():
+                self._emit({"event": "start", "path": epub_path})
+                r = pool.convert(epub_path, base_output_folder, job_options, with_lines, emit)
+            self._emit({"event": "done", "ok": r["ok"], "title": r.get("title"), "chapters": r["chapters"],
+                        "lines": r["lines"], "cached": bool(r.get("cached")), "output_dir": r["output_dir"],
+                        "files": r["files"], "records": r.get("records"), "seconds": round(r["seconds"], 3),
+                        "error": r.get("error")})
+            if summary and r["ok"] and not r.get("cached"):
+                summary.book_finished(r["output_dir"])
+
+    return _WorkerHandler
+
+def _warm_up(text_backend=None):
+    # 预先完成 lxml/libxml2、html.parser 与 ElementTree 的一次性初始化，避免首个任务付出这部分延迟
+    backend = _get_text_backend(text_backend)
+    backend.document("<html><head><title>t</title></head><body><h1>h</h1><p>p&nbsp;</p></body></html>")
+    ET.fromstring('<package xmlns="http://www.idpf.org/2007/opf"><metadata/></package>')
+    return backend
+
+def _serve(address, base_output_folder, jobs, options=None, max_queue=_DEFAULT_SERVE_QUEUE,
+           max_upload_bytes=_DEFAULT_MAX_UPLOAD_BYTES):
+    """
+    以常驻进程运行转换服务。address 为 "HOST:PORT"、"PORT" 或 "unix:/path/to.sock"。
+    转换在常驻并预热的 jobs 个工作进程中并行执行，请求线程只负责转发事件；_JobSlots 负责准入与限流。
+    """
+    import socketserver
+    from http.server import ThreadingHTTPServer
+    options = dict(options or {})
+    backend = _get_text_backend(options.get("text_backend"))
+    pool = _ServePool(jobs, options.get("text_backend"))
+    slots = _JobSlots(jobs, max_queue)
+    summary = _LibrarySummaryWriter(base_output_folder) if options.get("analytics") else None
+    handler = _make_worker_handler(base_output_folder, slots, pool, options, max_upload_bytes, summary)
+    try:
+        if address.startswith("unix:"):
+            sock_path = address[len("unix:"):]
+            if os.path.exists(sock_path):
+                os.remove(sock_path)
+
+            class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+                daemon_threads = True
+
+            server = _UnixHTTPServer(sock_path, handler)
+        else:
+            host, _, port = address.rpartition(":")
+            server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), handler)
+            server.daemon_threads = True
+    except BaseException:
+        pool.close()
+        raise
+    def on_sigterm(signum, frame):
+        raise KeyboardInterrupt
+
+    # 以 SIGTERM 停止时同样关闭工作进程池，避免留下孤儿进程
+    import signal
+    signal.signal(signal.SIGTERM, on_sigterm)
+    print(f"转换服务已启动: {address} (后端 {backend.name}, 并发 {jobs}, 等待队列 {max_queue})，输出目录 {base_output_folder}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n服务已停止。")
+    finally:
+        server.server_close()
+        pool.close()
+        if summary:
+            summary.close()
+        if address.startswith("unix:"):
+            with contextlib.suppress(OSError):
+                os.remove(address[len("unix:"):])
+
+_JOURNAL_NAME = ".epub2md-journal.jsonl"
+_METRICS_NAME = ".epub2md-metrics.json"
+
+class _JobJournal:
+    """
+    监视模式的任务日志：每次状态变化 (queued / running / done / failed) 追加一行 JSON 并 fsync，
+    崩溃或重启后按每个文件的最后一条记录恢复：已完成且文件未变的跳过，排队或进行中的重新排队。
+    打开时把日志压缩为每个文件一条记录。
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # 崩溃时可能留下半行
+                        continue
+                    if isinstance(rec, dict) and rec.get("path"):
+                        self.entries[rec["path"]] = rec
+        except OSError:
+            pass
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for rec in self.entries.values():
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, path)
+        self._f = open(path, "a", encoding="utf-8")
+
+    def record(self, path, sig, state, **extra):
+        rec = dict(path=path, sig=list(sig), state=state, ts=time.time(), **extra)
+        self.entries[path] = rec
+        self._f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def is_finished(self, path, sig):
+        rec = self.entries.get(path)
+        return bool(rec) and rec.get("sig") == list(sig) and rec.get("state") in ("done", "failed")
+
+    def unfinished(self):
+        return [p for p, rec in self.entries.items() if rec.get("state") in ("queued", "running")]
+
+    def close(self):
+        self._f.close()
+
+class _InotifyWatcher:
+    """通过 ctypes 调用 inotify，仅用于及时唤醒主循环；是否需要转换始终以目录扫描结果为准。"""
+    # IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    _MASK = 0x08 | 0x40 | 0x80 | 0x100 | 0x200
+
+    def __init__(self, path):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), self._MASK) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"无法监视目录: {path}")
+        self.name = "inotify"
+
+    def wait(self, timeout):
+        import select
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        with contextlib.suppress(BlockingIOError):
+            while os.read(self.fd, 65536):
+                pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+class _PollingWatcher:
+    name = "polling"
+
+    def __init__(self, interval):
+        self.interval = interval
+
+    def wait(self, timeout):
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        return True
+
+    def close(self):
+        pass
+
+def _make_watcher(path, poll_interval, use_inotify=True):
+    if use_inotify and sys.platform.startswith("linux"):
+        try:
+            return _InotifyWatcher(path)
+        except (OSError, AttributeError) as e:
+            print(f"inotify 不可用 ({e})，改用轮询。")
+    return _PollingWatcher(poll_interval)
+
+def _scan_inbox(watch_dir):
+    found = {}
+    with os.scandir(watch_dir) as it:
+        for entry in it:
+            if entry.name.startswith(".") or not entry.name.lower().endswith(".epub"):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if entry.is_file():
+                found[entry.path] = (st.st_size, st.st_mtime_ns)
+    return found
+
+class _WatchMetrics:
+    """监视模式的吞吐量与队列深度统计，最近窗口内的速率用于观察积压是否在消化。"""
+    def __init__(self, window_seconds=300):
+        from collections import deque
+        self.started = time.time()
+        self.window_seconds = window_seconds
+        self.recent = deque()
+        self.done = 0
+        self.failed = 0
+        self.bytes_done = 0
+
+    def job_finished(self, ok, size, seconds, latency):
+        if ok:
+            self.done += 1
+            self.bytes_done += size
+        else:
+            self.failed += 1
+        now = time.time()
+        self.recent.append((now, size, seconds, latency))
+        while self.recent and now - self.recent[0][0] > self.window_seconds:
+            self.recent.popleft()
+
+    def snapshot(self, settling, queued, running):
+        now = time.time()
+        while self.recent and now - self.recent[0][0] > self.window_seconds:
+            self.recent.popleft()
+        window = min(self.window_seconds, max(now - self.started, 1e-9))
+        n = len(self.recent)
+        return {
+            "uptime_seconds": round(now - self.started, 1),
+            "done": self.done,
+            "failed": self.failed,
+            "bytes_done": self.bytes_done,
+            "queue_depth": settling + queued,
+            "settling": settling,
+            "queued": queued,
+            "running": running,
+            "books_per_minute": round(n * 60 / window, 2),
+            "mb_per_second": round(sum(r[1] for r in self.recent) / window / (1024 * 1024), 3),
+            "avg_convert_seconds": round(sum(r[2] for r in self.recent) / n, 3) if n else None,
+            "avg_latency_seconds": round(sum(r[3] for r in self.recent) / n, 3) if n else None,
+        }
+
+def _watch(watch_dir, base_output_folder, jobs, options=None, settle_seconds=2.0, poll_interval=2.0,
+           metrics_interval=30.0, use_inotify=True, exit_when_idle=False):
+    """
+    监视 watch_dir（不递归）中新增或变化的 .epub，大小与修改时间在 settle_seconds 内保持不变才认为复制完成，
+    然后交给进程池转换。任务状态写入目录下的 .epub2md-journal.jsonl，指标定期写入 .epub2md-metrics.json。
+    """
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    watch_dir = os.path.abspath(watch_dir)
+    journal = _JobJournal(os.path.join(watch_dir, _JOURNAL_NAME))
+    watcher = _make_watcher(watch_dir, poll_interval, use_inotify)
+    metrics = _WatchMetrics()
+    settling = {}
+    pending = deque()
+    running = {}
+    current = _scan_inbox(watch_dir)
+    for path in journal.unfinished():
+        if path in current:
+            pending.append((path, current[path], time.time()))
+            journal.record(path, current[path], "queued", resumed=True)
+    if pending:
+        print(f"从任务日志恢复 {len(pending)} 个未完成的任务。")
+    print(f"正在监视 {watch_dir} ({watcher.name}, 并发 {jobs})，输出目录 {base_output_folder}。按 Ctrl+C 停止。")
+    metrics_path = os.path.join(watch_dir, _METRICS_NAME)
+    next_metrics = time.monotonic() + metrics_interval
+    last_printed = None
+
+    def on_sigterm(signum, frame):
+        raise KeyboardInterrupt
+
+    # 作为服务运行时通常以 SIGTERM 停止，与 Ctrl+C 一样收尾
+    import signal
+    signal.signal(signal.SIGTERM, on_sigterm)
+    summary = _LibrarySummaryWriter(base_output_folder) if (options or {}).get("analytics") else None
+    pool = ProcessPoolExecutor(max_workers=jobs)
+    try:
+        while True:
+            now = time.monotonic()
+            busy = {p for p, _, _ in pending} | {job[0] for job in running.values()}
+            current = _scan_inbox(watch_dir)
+            for path in list(settling):
+                if path not in current:
+                    del settling[path]
+            for path, sig in current.items():
+                if path in busy or journal.is_finished(path, sig):
+                    continue
+                prev = settling.get(path)
+                if prev is None or prev[0] != sig:
+                    settling[path] = (sig, now)
+                elif now - prev[1] >= settle_seconds:
+                    del settling[path]
+                    pending.append((path, sig, time.time()))
+                    journal.record(path, sig, "queued")
+
+            while pending and len(running) < jobs:
+                path, sig, queued_at = pending.popleft()
+                fut = pool.submit(_convert_book_job, path, base_output_folder, options, False)
+                running[fut] = (path, sig, queued_at)
+                journal.record(path, sig, "running")
+
+            if running:
+                done, _ = wait(list(running), timeout=0, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    path, sig, queued_at = running.pop(fut)
+                    try:
+                        r = fut.result()
+                    except Exception as e:
+                        r = {"ok": False, "seconds": 0.0, "error": f"{type(e).__name__}: {e}"}
+                    state = "done" if r.get("ok") else "failed"
+                    journal.record(path, sig, state, output_dir=r.get("output_dir"), error=r.get("error"),
+                                   seconds=round(r.get("seconds", 0.0), 3))
+                    metrics.job_finished(r.get("ok"), sig[0], r.get("seconds", 0.0), time.time() - queued_at)
+                    if r.get("ok"):
+                        print(f"成功: {path} -> {r['output_dir']} ({r.get('chapters', 0)} 章, {r['seconds']:.2f}s)")
+                        if summary and not r.get("cached"):
+                            summary.book_finished(r["output_dir"])
+                    else:
+                        print(f"失败: {path} | {r.get('error')}")
+
+            if time.monotonic() >= next_metrics:
+                snap = metrics.snapshot(len(settling), len(pending), len(running))
+                _write_json_atomic(metrics_path, snap)
+                counters = (snap["done"], snap["failed"], snap["queue_depth"], snap["running"])
+                if counters != last_printed:
+                    last_printed = counters
+                    print(f"[指标] 完成 {snap['done']} 失败 {snap['failed']} | 队列 {snap['queue_depth']} "
+                          f"运行 {snap['running']} | {snap['books_per_minute']} 本/分钟, {snap['mb_per_second']} MB/s")
+                next_metrics = time.monotonic() + metrics_interval
+
+            if exit_when_idle and not (settling or pending or running):
+                break
+            # 有文件在等待稳定或有任务在运行时需要定时醒来；否则只等文件系统事件（轮询模式按间隔）
+            if settling:
+                timeout = max(0.05, min(settle_seconds - (time.monotonic() - t) for _, t in settling.values()))
+            elif running or pending:
+                timeout = 0.2
+            else:
+                timeout = min(metrics_interval, max(0.05, next_metrics - time.monotonic()))
+            watcher.wait(timeout)
+    except KeyboardInterrupt:
+        print("\n监视已停止；未完成的任务将在下次启动时恢复。")
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        if summary:
+            summary.close()
+        _write_json_atomic(metrics_path, metrics.snapshot(len(settling), len(pending), len(running)))
+        watcher.close()
+        journal.close()
 
 # 主程序执行部分
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="将EPUB转换为按章节拆分的Markdown文件")
+    parser.add_argument("epub_paths", nargs="*", help="EPUB文件路径；省略时弹出macOS文件选择对话框")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="并行转换的进程数；大于1时以非交互批量模式运行")
+    parser.add_argument("--text-backend", choices=["auto"] + sorted(_TEXT_BACKENDS), default="auto",
+                        help="HTML转文本后端；auto 在安装了 lxml 时使用 lxml，否则使用 bs4")
+    parser.add_argument("--force", action="store_true", help="忽略已有转换结果与缓存，强制重新转换")
+    parser.add_argument("--no-cache", action="store_true", help="不使用增量转换缓存")
+    parser.add_argument("--cache-dir", help="共享缓存目录，默认为输出目录下的 .epub2md-cache")
+    parser.add_argument("--cache-max-mb", type=int, default=_DEFAULT_CACHE_MAX_BYTES // (1024 * 1024),
+                        help="缓存大小上限(MB)，超出时按最近最少使用淘汰")
+    parser.add_argument("--records", choices=_RECORDS_FORMATS,
+                        help="额外输出与 chapters/paragraphs 表结构一致的预分段记录 (NDJSON 或可直接 COPY 的 CSV)")
+    parser.add_argument("--book-id", help="写入记录时使用的书籍 id (仅限单本书)，默认随机生成 UUID")
+    parser.add_argument("--interactive", action="store_true",
+                        help="无目录的书在写出前交互预览章节标题并允许手动调整（仅限单进程模式）")
+    parser.add_argument("--title-rules", metavar="PATH",
+                        help="章节标题规则文件，或存放 <书名>.titles.json 的目录；默认使用 EPUB 旁的同名 sidecar")
+    parser.add_argument("--tts-chunks", action="store_true",
+                        help=f"为每章额外写出 .tts.json：按句/分句切好的朗读片段（每段不超过 {_TTS_MAX_BYTES} 字节），附词数与停顿系数")
+    parser.add_argument("--images", action="store_true",
+                        help="提取正文引用的图片：按内容去重存入共享图片目录，生成网页尺寸与缩略图 (需要 Pillow)，并写出每章图片索引")
+    parser.add_argument("--images-dir", help="配合 --images，共享图片目录，默认为输出目录下的 .epub2md-images")
+    parser.add_argument("--analytics", action="store_true",
+                        help="统计每本书的词汇量、句长分布、可读性与朗读时长 (<书名>_stats.json)，并汇总为输出目录下的 library_stats.json")
+    parser.add_argument("--bundle", choices=_BUNDLE_FORMATS,
+                        help="把每本书打包为输出目录下的单个 .zip / .tar 文件（适合小文件写入很慢的网络文件系统）")
+    parser.add_argument("--guarded", action="store_true",
+                        help="受限模式：读取前按中央目录检查解压大小、成员数与压缩比，超大 XHTML 分块解析")
+    parser.add_argument("--max-total-mb", type=int, default=512, help="配合 --guarded，解压后总大小上限(MB)")
+    parser.add_argument("--max-member-mb", type=int, default=64, help="配合 --guarded，单个成员解压后大小上限(MB)")
+    parser.add_argument("--max-members", type=int, default=10000, help="配合 --guarded，成员数上限")
+    parser.add_argument("--max-ratio", type=int, default=100, help="配合 --guarded，单个成员的压缩比上限")
+    parser.add_argument("--chunk-kb", type=int, default=1024, help="配合 --guarded，单次解析的 XHTML 大小上限(K字符)")
+    parser.add_argument("--library-db", metavar="PATH",
+                        help="同时写入 SQLite 书库 (books/chapters/lines + FTS5 全文索引)，重复转换同一本书会整本替换")
+    parser.add_argument("--search", metavar="QUERY", help="配合 --library-db，在书库中全文检索后退出")
+    parser.add_argument("--watch", metavar="DIR",
+                        help="守护模式：监视目录中新增或变化的 EPUB 并自动转换，任务状态记录在目录下的日志中，重启后可恢复")
+    parser.add_argument("--settle-seconds", type=float, default=2.0,
+                        help="配合 --watch，文件大小与修改时间保持不变多久后才认为复制完成")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="配合 --watch，轮询模式的扫描间隔(秒)")
+    parser.add_argument("--no-inotify", action="store_true", help="配合 --watch，不使用 inotify，始终轮询")
+    parser.add_argument("--metrics-interval", type=float, default=30.0,
+                        help="配合 --watch，输出吞吐量与队列深度指标的间隔(秒)")
+    parser.add_argument("--exit-when-idle", action="store_true", help="配合 --watch，处理完目录中现有文件后退出")
+    parser.add_argument("--serve", metavar="ADDRESS",
+                        help="以常驻服务运行，监听 HOST:PORT、PORT 或 unix:/path.sock，通过 HTTP 接收转换任务")
+    parser.add_argument("--max-queue", type=int, default=_DEFAULT_SERVE_QUEUE,
+                        help="配合 --serve，并发名额之外允许等待的任务数，超出时返回 503")
+    parser.add_argument("--stats", metavar="PATH",
+                        help="把每本书各阶段的耗时、读写字节与峰值内存以及批次汇总写成JSON报告")
+    parser.add_argument("--stats-memory", action="store_true",
+                        help="配合 --stats，用 tracemalloc 记录每个阶段的内存峰值（会拖慢转换）")
+    parser.add_argument("--profile", metavar="PATH", help="用 cProfile 分析，并把最慢那本书的结果保存为 PATH (.prof)")
+    args = parser.parse_args()
+    try:
+        _get_text_backend(args.text_backend)
+    except ImportError as e:
+        print(f"错误: 无法使用文本提取后端 '{args.text_backend}': {e}")
+        sys.exit(1)
+
+    if args.images and _load_pil() is None:
+        print("提示: 未安装 Pillow，--images 只保存去重后的原图，不生成网页尺寸图与缩略图。")
+
+    limits = None
+    if args.guarded:
+        limits = _ArchiveLimits(args.max_total_mb * 1024 * 1024, args.max_member_mb * 1024 * 1024, args.max_members,
+                                args.max_ratio, args.chunk_kb * 1024)
+
+    if args.search:
+        if not args.library_db:
+            print("错误: --search 需要同时指定 --library-db。")
+            sys.exit(1)
+        library = _LibraryDB(args.library_db)
+        try:
+            hits = library.search(args.search, limit=50)
+        finally:
+            library.close()
+        for title, chapter_index, chapter_title, line_no, text in hits:
+            print(f"{title} | 第{chapter_index}章 {chapter_title} | 第{line_no}行: {text}")
+        print(f"共 {len(hits)} 条结果。")
+        sys.exit(0)
+
+    if args.serve or args.watch:
+        desktop_path = os.path.join(os.path.expanduser("~"), "Desktop")
+        daemon_options = {"text_backend": args.text_backend, "force": args.force, "records_format": args.records,
+                          "library_db": args.library_db, "limits": limits, "title_rules": args.title_rules,
+                          "tts_chunks": args.tts_chunks,
+                          "images_dir": (args.images_dir or os.path.join(desktop_path, ".epub2md-images")) if args.images else None,
+                          "analytics": args.analytics, "bundle": args.bundle}
+        if not args.no_cache:
+            cache_dir = args.cache_dir or os.path.join(desktop_path, ".epub2md-cache")
+            daemon_options["cache"] = _ConversionCache(cache_dir, args.cache_max_mb * 1024 * 1024)
+        if args.watch:
+            _watch(args.watch, desktop_path, max(1, args.jobs), daemon_options, args.settle_seconds, args.poll_interval,
+                   args.metrics_interval, not args.no_inotify, args.exit_when_idle)
+        else:
+            _serve(args.serve, desktop_path, max(1, args.jobs), daemon_options, args.max_queue)
+        sys.exit(0)
+
     epub_files_to_process = []
-    if len(sys.argv) > 1:
-        for arg in sys.argv[1:]:
+    if args.epub_paths:
+        for arg in args.epub_paths:
             if isinstance(arg, str) and arg.lower().endswith('.epub'):
                 epub_files_to_process.append(arg)
         if not epub_files_to_process:
@@ -504,20 +3430,62 @@ if __name__ == "__main__":
     
     # Markdown文件将保存在用户桌面上的一个子目录中
     desktop_path = os.path.join(os.path.expanduser("~"), "Desktop")
-    
-    for epub_path in epub_files_to_process:
-        print(f"正在处理EPUB文件: {epub_path}...")
-        generated_files_list, output_book_folder = convert_epub_to_markdown(epub_path, desktop_path)
-        if generated_files_list:
-            print("\n成功! Markdown文件已保存在以下目录中：")
-            print(output_book_folder)
-            print("\n生成的文件列表:")
-            for f_path in generated_files_list:
-                try:
-                    with open(f_path, 'r', encoding='utf-8') as rf:
-                        first_line = rf.readline().strip()
-                    print(f"- {os.path.basename(f_path)} | {first_line}")
-                except Exception:
-                    print(f"- {os.path.basename(f_path)}")
-        else:
-            print("\n未能从EPUB生成Markdown文件。请检查上面的错误信息。")
+
+    if args.book_id and len(epub_files_to_process) > 1:
+        print("错误: --book-id 只能用于单本书。")
+        sys.exit(1)
+    convert_options = {"text_backend": args.text_backend, "force": args.force,
+                       "records_format": args.records, "book_id": args.book_id, "library_db": args.library_db,
+                       "limits": limits, "title_rules": args.title_rules,
+                       "tts_chunks": args.tts_chunks,
+                       "images_dir": (args.images_dir or os.path.join(desktop_path, ".epub2md-images")) if args.images else None,
+                       "analytics": args.analytics, "bundle": args.bundle}
+    if not args.no_cache:
+        cache_dir = args.cache_dir or os.path.join(desktop_path, ".epub2md-cache")
+        convert_options["cache"] = _ConversionCache(cache_dir, args.cache_max_mb * 1024 * 1024)
+
+    profile_dir = tempfile.mkdtemp(prefix="epub2md-prof-") if args.profile else None
+    batch_t0 = time.perf_counter()
+    if args.jobs > 1:
+        reports = _run_batch(epub_files_to_process, desktop_path, args.jobs, convert_options,
+                             collect_stats=bool(args.stats), trace_memory=args.stats_memory, profile_dir=profile_dir)
+    else:
+        reports = []
+        for epub_path in epub_files_to_process:
+            print(f"正在处理EPUB文件: {epub_path}...")
+            r = _convert_book_job(epub_path, desktop_path, convert_options, interactive=args.interactive,
+                                  collect_stats=bool(args.stats), trace_memory=args.stats_memory,
+                                  profile_dir=profile_dir)
+            reports.append(r)
+            if r["ok"] and args.bundle:
+                print("\n成功! 整本书已打包为：")
+                print(r["output_dir"])
+            elif r["ok"]:
+                print("\n成功! Markdown文件已保存在以下目录中：")
+                print(r["output_dir"])
+                print("\n生成的文件列表:")
+                for f_path in r["files"]:
+                    try:
+                        with open(f_path, 'r', encoding='utf-8') as rf:
+                            first_line = rf.readline().strip()
+                        print(f"- {os.path.basename(f_path)} | {first_line}")
+                    except Exception:
+                        print(f"- {os.path.basename(f_path)}")
+            else:
+                print("\n未能从EPUB生成Markdown文件。请检查上面的错误信息。")
+
+    if "cache" in convert_options:
+        # 每批结束时完整淘汰一次；批内各进程只在写入量足够大时才扫描缓存目录
+        convert_options["cache"].evict()
+    if args.analytics:
+        print(f"\n全库统计已写入: {_write_library_summary(desktop_path)}")
+    if args.stats:
+        _write_stats_report(args.stats, reports, time.perf_counter() - batch_t0)
+        print(f"\n统计报告已写入: {args.stats}")
+    if profile_dir:
+        slowest = _keep_slowest_profile(reports, args.profile)
+        shutil.rmtree(profile_dir, ignore_errors=True)
+        if slowest:
+            print(f"最慢的书 ({slowest['path']}, {slowest['seconds']:.2f}s) 的 cProfile 结果已写入: {args.profile}")
+    if args.jobs > 1:
+        sys.exit(0 if all(r.get("ok") for r in reports) else 1)